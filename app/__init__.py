@@ -10,6 +10,9 @@ from flask import render_template
 
 from app.config import Config
 from app.extensions import db, login_manager, migrate, celery_init_app
+from app.activity.tracker import activity_tracker
+from app.timeseries.ingest import sample_buffer
+from app.timeseries.commands import measurements_cli
 
 from app.admin.admin import admin as admin_blueprint
 from app.auth.auth import auth as auth_blueprint
@@ -30,6 +33,13 @@ def create_app():
     db.init_app(app)
     migrate.init_app(app, db)
 
+    ## Activity tracker (write-behind of last_activity)
+    activity_tracker.init_app(app)
+
+    ## Response time samples (batched writes) and moving old samples to RttSample
+    sample_buffer.init_app(app)
+    app.cli.add_command(measurements_cli)
+
     if getenv('FLASK_DB') == "populate":
         # pylint: disable=C0415:import-outside-toplevel
         from app.models.node import Node
@@ -42,7 +52,7 @@ def create_app():
         # pylint: disable=C0415:import-outside-toplevel,W0611:unused-import
         from app.models.network import Network
         # pylint: disable=C0415:import-outside-toplevel
-        from app.models.measurements import ResponseTimeCubicle, ResponseTimeNode
+        from app.models.timeseries import RttSample
 
         with app.app_context():
             db.create_all()
@@ -81,9 +91,10 @@ def create_app():
                 print(session.query(User).all())
 
             # Install responsetime logs. Test-purpose
-            if len(session.query(ResponseTimeCubicle).all()) == 0:
-                from app.models.measurements import setup as measurement_setup
-                measurement_setup(session)
+            if session.query(RttSample).first() is None:
+                # pylint: disable=C0415:import-outside-toplevel
+                from app.models.timeseries import setup as timeseries_setup
+                timeseries_setup(session)
 
     ## Celery
     celery_init_app(app)
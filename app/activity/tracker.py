@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind tracker for 'last_activity' of users and nodes
+
+Requests only record a timestamp in memory. Repeated touches of the same user/node
+are merged and written to the database in one bulk UPDATE every flush interval.
+Readers use user_last_activity()/node_last_activity() to see values not yet flushed.
+"""
+
+import atexit
+import time
+from datetime import datetime
+from threading import Lock, Thread
+
+from flask import Flask
+from sqlalchemy import update
+
+from app.config import ACTIVITY_FLUSH_INTERVAL
+from app.extensions import db, logger
+
+from app.models.node import Node
+from app.models.user import User
+
+class ActivityTracker():
+    """ Collect last_activity timestamps and flush them in bulk """
+
+    def __init__(self, flush_interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {
+            User: {},
+            Node: {},
+        }
+        self._lock = Lock()
+        self._app = None
+        self._flusher = None
+
+    def init_app(self, app: Flask):
+        """ Bind tracker to the Flask app. Pending values are flushed on exit """
+        self._app = app
+        app.extensions["activity_tracker"] = self
+        atexit.register(self._flush_with_context)
+
+    def touch_user(self, user_id: int, timestamp: datetime|None = None):
+        """ Mark user as active """
+        self._touch(User, user_id, timestamp)
+
+    def touch_node(self, node_id: int, timestamp: datetime|None = None):
+        """ Mark node as active """
+        self._touch(Node, node_id, timestamp)
+
+    def user_last_activity(self, user_id: int, stored: datetime|None) -> datetime|None:
+        """ Return the newest of the stored value and the pending value for a user """
+        return self._newest(User, user_id, stored)
+
+    def node_last_activity(self, node_id: int, stored: datetime|None) -> datetime|None:
+        """ Return the newest of the stored value and the pending value for a node """
+        return self._newest(Node, node_id, stored)
+
+    def flush(self) -> int:
+        """ Write all pending timestamps. Must be called within an app context """
+        with self._lock:
+            pending = self._pending
+            self._pending = {model: {} for model in pending}
+
+        written = 0
+        try:
+            for model, timestamps in pending.items():
+                if not timestamps:
+                    continue
+                db.session.execute(
+                    update(model),
+                    [{"id": _id, "last_activity": ts} for _id, ts in timestamps.items()]
+                )
+                written += len(timestamps)
+            db.session.commit()
+        # pylint: disable=W0718:broad-exception-caught
+        except Exception as _error:
+            db.session.rollback()
+            logger.warning(f"Could not flush last activity: {_error}")
+            # Put the values back so they are retried on the next flush
+            for model, timestamps in pending.items():
+                for _id, timestamp in timestamps.items():
+                    self._touch(model, _id, timestamp, start_flusher=False)
+            return 0
+
+        return written
+
+    def _touch(self, model, _id: int, timestamp: datetime|None, start_flusher: bool = True):
+        if _id is None:
+            return
+        timestamp = timestamp or datetime.utcnow()
+        with self._lock:
+            current = self._pending[model].get(_id)
+            if current is None or current < timestamp:
+                self._pending[model][_id] = timestamp
+        if start_flusher:
+            self._ensure_flusher()
+
+    def _newest(self, model, _id: int, stored: datetime|None) -> datetime|None:
+        with self._lock:
+            pending = self._pending[model].get(_id)
+        if pending is None:
+            return stored
+        if stored is None:
+            return pending
+        # Values from the database may carry a timezone while pending values do not
+        if stored.tzinfo is not None:
+            stored = stored.replace(tzinfo=None)
+        return max(stored, pending)
+
+    def _ensure_flusher(self):
+        """ Start the background flusher the first time something is tracked """
+        if self._flusher is not None or self._app is None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = Thread(target=self._run, name="activity-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_with_context()
+
+    def _flush_with_context(self):
+        if self._app is None:
+            return
+        with self._app.app_context():
+            self.flush()
+
+activity_tracker = ActivityTracker()
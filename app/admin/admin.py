@@ -4,6 +4,7 @@
 """ Admin blueprint """
 
 import re
+import time
 
 from ipaddress import ip_network, ip_address
 from functools import wraps
@@ -14,7 +15,7 @@ from io import BytesIO
 import pyotp
 import qrcode
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, jsonify, request, url_for
 from flask import render_template
 from flask_login import login_required, current_user
 
@@ -23,15 +24,37 @@ from app.models.node import Node, get_status_string
 from app.models.image import Image
 from app.models.cubicle import Cubicle
 from app.models.events import EventLog
-from app.models.measurements import ResponseTimeCubicle, ResponseTimeNode
-from app.models.measurements import create_timestamp_graph
+from app.models.measurements import ResponseTimeCubicle
 
-from app.config import MIN_PASSWORD_LENGTH, MIN_USERNAME_LENGTH, CPU_LIMIT
+from app.config import MIN_PASSWORD_LENGTH, MIN_USERNAME_LENGTH, CPU_LIMIT, GRAPH_CACHE_TTL
+from app.config import SERIES_DEFAULT_WIDTH, SERIES_MAX_WIDTH
 from app.extensions import db, login_manager
+from app.activity.tracker import activity_tracker
+from app.cache.nodes import invalidate_node_index
+from app.cache.graphs import SOURCES as GRAPH_SOURCES, DEFAULT_TIME_RANGE
+from app.cache.graphs import graph_cache, list_graphs, parse_time_range
+from app.timeseries.samples import SOURCES as SAMPLE_SOURCES, entity_name, load_samples
+from app.timeseries.downsample import LTTB, METHODS as DOWNSAMPLE_METHODS, downsample
 from app.models.network import generate_networks
+from app.tasks.schedule import request_reconcile
+from app.admin.overview import ONLINE, IDLE, OFFLINE, USER_ACTIVITY, NODE_ACTIVITY, status_of
+from app.admin.overview import users_table, nodes_table, images_table, cubicles_table
+from app.tasks.breaker import HEALTHY, STATE_CLOSED, STATE_BACKOFF, STATE_HALF_OPEN, load_health
 
 admin = Blueprint('admin', __name__, template_folder='templates')
 
+USER_STATUS = {
+    ONLINE: {'msg': "Online", 'class': "status-ok"},
+    IDLE: {'msg': "Idle", 'class': "status-warning"},
+    OFFLINE: {'msg': "Offline", 'class': "status-normal"},
+}
+
+NODE_STATUS_CLASS = {
+    ONLINE: "status-ok",
+    IDLE: "status-warning",
+    OFFLINE: "status-error",
+}
+
 def admin_required(func):
     """ Verify that logged in user actually is admin """
     @wraps(func)
@@ -44,124 +67,76 @@ def admin_required(func):
         return func(*args, **kwargs)
     return inner
 
+def get_polling_status(health, now: float) -> dict:
+    """ How often a node is polled, for the node table """
+    state = health.state(now)
+    if state == STATE_CLOSED:
+        return {'msg': "Normal", 'class': "status-ok"}
+    if state == STATE_HALF_OPEN:
+        return {'msg': f"Trial ({health.failures} failures)", 'class': "status-warning"}
+    wait = max(0, int(health.next_check - now))
+    if state == STATE_BACKOFF:
+        return {'msg': f"Backoff {wait}s ({health.failures} failures)", 'class': "status-warning"}
+    return {'msg': f"Open {wait}s ({health.failures} failures)", 'class': "status-error"}
+
 @admin.before_request
 def update_last_activity():
     """ Update last_activity timer """
     if not current_user.is_authenticated:
         return
-    user = User.query.filter_by(id=current_user.id).first()
-    user.last_activity = datetime.utcnow()
-    db.session.commit()
+    activity_tracker.touch_user(current_user.id)
 
 
 @admin.route('/')
 #@login_required
 #@admin_required
 def main():
-    """ Main route for admin GUI """
+    """
+    Main route for admin GUI. Every table is paged, sorted and filtered by the database,
+    see app.admin.overview for the query string parameters
+    """
+    # The status filters use last_activity as stored, i.e. as of the last flush of the
+    # activity tracker. The status shown also includes activity not flushed yet
+
     # Get information about users
-    users = []
-    for user in User.query.all():
-        name = user.name if user.name is not None else ""
-        username = user.username if user.username is not None else ""
-        if user.last_activity < datetime.utcnow() - timedelta(hours=1):
-            status_msg = "Offline"
-            status_class = "status-normal"
-        elif user.last_activity < datetime.utcnow() - timedelta(minutes=1):
-            status_msg = "Idle"
-            status_class = "status-warning"
-        else:
-            status_msg = "Online"
-            status_class = "status-ok"
-
-        users.append({
-            'id': user.id,
-            'name': name,
-            'username': username,
-            'admin': user.admin,
-            'online_status': {
-                'msg': status_msg,
-                'class': status_class
-            }
-        })
+    users = users_table.page(request.args)
+    for user in users.rows:
+        user['name'] = user['name'] if user['name'] is not None else ""
+        user['username'] = user['username'] if user['username'] is not None else ""
+        last_activity = activity_tracker.user_last_activity(user['id'], user['last_activity'])
+        user['online_status'] = USER_STATUS[status_of(last_activity, *USER_ACTIVITY)]
 
     # Get information about nodes
-    nodes = []
-    for _id, name, last_activity, _ip_address, network_range, response_time, status in db.session.execute(db.select(Node.id, Node.name, Node.last_activity, Node.ip_address, Node.network_range, Node.response_time, Node.status)).all():
-        name = name if name is not None else ""
-        if last_activity < datetime.utcnow() - timedelta(minutes=3):
-            status_msg = "Offline"
-            status_class = "status-error"
-        elif last_activity < datetime.utcnow() - timedelta(minutes=1):
-            status_msg = "Idle"
-            status_class = "status-warning"
-        else:
-            status_msg = "Online"
-            status_class = "status-ok"
-#        return render_template('admin/modal/error.html')
-        status_msg = get_status_string(status)
-
-        nodes.append({
-            'id': _id,
-            'name': name,
-            'ip': _ip_address,
-            'network_range': network_range,
-            'response_time': response_time,
-            'online_status': {
-                'msg': status_msg,
-                'class': status_class
-            }
-        })
+    nodes = nodes_table.page(request.args)
+    health = load_health()
+    now = time.time()
+    for node in nodes.rows:
+        node['name'] = node['name'] if node['name'] is not None else ""
+        last_activity = activity_tracker.node_last_activity(node['id'], node['last_activity'])
+        node['online_status'] = {
+            'msg': get_status_string(node['status']),
+            'class': NODE_STATUS_CLASS[status_of(last_activity, *NODE_ACTIVITY)],
+        }
+        node['polling'] = get_polling_status(health.get(node['id'], HEALTHY), now)
 
     # Get information about images
-    images = []
-    for image in Image.query.all():
-        name = image.name if image.name is not None else ""
-        source = image.image if image.image is not None else ""
-        cpu_limit = image.cpu_limit if image.cpu_limit is not None else "no limit"
-        mem_limit = image.mem_limit if image.mem_limit is not None else "no limit"
-        images.append({
-            'id': image.id,
-            'name': name,
-            'source': source,
-            'cpu_limit': cpu_limit,
-            'mem_limit': mem_limit,
-        })
+    images = images_table.page(request.args)
+    for image in images.rows:
+        image['name'] = image['name'] if image['name'] is not None else ""
+        image['source'] = image['source'] if image['source'] is not None else ""
+        image['cpu_limit'] = image['cpu_limit'] if image['cpu_limit'] is not None else "no limit"
+        image['mem_limit'] = image['mem_limit'] if image['mem_limit'] is not None else "no limit"
 
     # Get information about cubicles
-    cubicles = []
-    for cubicle in Cubicle.query.all():
-        name = cubicle.name if cubicle.name is not None else "Unknown"
-        user = cubicle.user.name if cubicle.user is not None else "Unknown"
-        image_name = cubicle.image.name if cubicle.image is not None else "Unknown"
-        node_name = cubicle.node.name if cubicle.node is not None else "Unknown"
-        response_time = cubicle.response_time
-        novnc_port = cubicle.novnc_port
-        network = "Unknown"
-        active = False
-
-        if cubicle.user is not None:
-            for net in cubicle.user.networks:
-                if net.node is None or cubicle.node is None:
-                    continue
-                if net.node.id != cubicle.node.id:
-                    continue
-                network = net.ip_range
-                break
-
-            active = cubicle.active
-
-        cubicles.append({
-            'id': cubicle.id,
-            'name': name,
-            'user': user, 
-            'image': image_name,
-            'node': node_name,
-            'novnc_port': novnc_port,
-            'response_time': response_time,
-            'network': network,
-            'active': active,
-        })
+    cubicles = cubicles_table.page(request.args)
+    for cubicle in cubicles.rows:
+        cubicle['name'] = cubicle['name'] if cubicle['name'] is not None else "Unknown"
+        cubicle['image'] = cubicle['image'] if cubicle['image'] is not None else "Unknown"
+        cubicle['node'] = cubicle['node'] if cubicle['node'] is not None else "Unknown"
+        cubicle['network'] = cubicle['network'] if cubicle['network'] is not None else "Unknown"
+        if cubicle['user_id'] is None:
+            cubicle['user'] = "Unknown"
+            cubicle['active'] = False
 
     return render_template('admin/main.html',
                            users=users,
@@ -288,6 +263,7 @@ def modal_add(_type):
 
             db.session.add(node)
             db.session.commit()
+            invalidate_node_index()
 
             return_msg = f"Node {name} added!"
 
@@ -431,26 +407,7 @@ def modal_get_id(_type, _id):
                 else:
                     val['nodes'][node.name] = False
         case 'measurement':
-            graphs = []
-
-            cubicle = Cubicle.query.filter_by(id=_id).first()
-            x_axis = []
-            y_axis = []
-
-            # pylint: disable=C0301:line-too-long
-            for reponse_time in ResponseTimeCubicle.query.filter_by(cubicle_id=cubicle.id).filter(ResponseTimeCubicle.timestamp > (datetime.now() - timedelta(hours=8))):
-                x_axis.append(reponse_time.timestamp)
-                y_axis.append(reponse_time.rtt)
-
-            graphs.append(
-                create_timestamp_graph(x_axis=x_axis,
-                                       y_axis=y_axis,
-                                       x_axis_name="Timestamp",
-                                       y_axis_name="RTT m/s",
-                                       title=f"Response Time (8h) - {cubicle.name}")
-                        )
-
-            val['graphs'] = graphs
+            val['graphs'] = [_graph_url(g) for g in list_graphs('cubicle', DEFAULT_TIME_RANGE, _id)]
         case _:
             return render_template('admin/modal/error.html')
 
@@ -507,11 +464,16 @@ def modal_update_id(_type, _id):
             # Add cubicle
             # TODO: Use an ID instead of name
             cubicle_name = request.form.get('cubicle')
+            cubicle = None
             if cubicle_name:
                 cubicle = Cubicle.query.filter_by(name=cubicle_name).first()
                 user.cubicles.append(cubicle)
             db.session.commit()
 
+            # A new owner changes what runs on the node
+            if cubicle is not None:
+                request_reconcile(cubicle.node_id, [cubicle.name])
+
             return_msg = f"User {user.name} updated!"
 
         case 'node':
@@ -552,6 +514,7 @@ def modal_update_id(_type, _id):
             node.last_activity = datetime.utcnow()
 
             db.session.commit()
+            invalidate_node_index()
 
             return_msg = f"Node {name} updated!"
 
@@ -591,6 +554,9 @@ def modal_update_id(_type, _id):
             if not cubicle:
                 return _modal_status_message('error', 'Unknown cubicle-id')
 
+            # Remember where the cubicle runs today, it may be moved or renamed
+            old_node_id, old_name = cubicle.node_id, cubicle.name
+
             success, error_msg, name = _normalize_object_name(request.form.get('name'))
             if not success:
                 return error_msg
@@ -615,6 +581,12 @@ def modal_update_id(_type, _id):
 
             db.session.commit()
 
+            if old_node_id == cubicle.node_id:
+                request_reconcile(cubicle.node_id, list({old_name, cubicle.name}))
+            else:
+                request_reconcile(old_node_id, [old_name])
+                request_reconcile(cubicle.node_id, [cubicle.name])
+
             return_msg = f"Cubicle {name} updated!"
 
         case _:
@@ -636,9 +608,25 @@ def modal_delete_id(_type, _id):
     if not obj:
         return f"Could not delete {_type}:{_id}"
 
-    db.session.delete(obj.query.filter_by(id=_id).first())
+    target = obj.query.filter_by(id=_id).first()
+
+    # Cubicles that must be stopped when the object is gone
+    affected = {}
+    if isinstance(target, Cubicle):
+        affected[target.node_id] = [target.name]
+    elif isinstance(target, User):
+        for cubicle in target.cubicles:
+            affected.setdefault(cubicle.node_id, []).append(cubicle.name)
+
+    db.session.delete(target)
     db.session.commit()
 
+    if isinstance(target, Node):
+        invalidate_node_index()
+
+    for node_id, names in affected.items():
+        request_reconcile(node_id, names)
+
     return_msg = f"Deleted {_type}:{_id}"
 
     return _modal_status_message('ok', return_msg)
@@ -654,56 +642,16 @@ def modal_get_measurement_id(_type, _id):
 
     obj = _get_type(_type)
 
-    if obj is None:
+    if obj is None or _type not in GRAPH_SOURCES:
         return render_template('admin/modal/error.html')
 
-    val = {}
-    match _type:
-        case 'node':
-            graphs = []
-
-            node = Node.query.filter_by(id=_id).first()
-            x_axis = []
-            y_axis = []
-
-            # pylint: disable=C0301:line-too-long
-            for reponse_time in ResponseTimeNode.query.filter_by(node_id=node.id).filter(ResponseTimeNode.timestamp > (datetime.now() - timedelta(hours=8))):
-                x_axis.append(reponse_time.timestamp)
-                y_axis.append(reponse_time.rtt)
-
-            graphs.append(
-                create_timestamp_graph(x_axis=x_axis,
-                                       y_axis=y_axis,
-                                       x_axis_name="Timestamp",
-                                       y_axis_name="RTT m/s",
-                                       title=f"Response Time (8h) - {node.name}")
-                        )
-
-            val['graphs'] = graphs        
-        case 'cubicle':
-            graphs = []
-
-            cubicle = Cubicle.query.filter_by(id=_id).first()
-            x_axis = []
-            y_axis = []
-
-            # pylint: disable=C0301:line-too-long
-            for reponse_time in ResponseTimeCubicle.query.filter_by(cubicle_id=cubicle.id).filter(ResponseTimeCubicle.timestamp > (datetime.now() - timedelta(hours=8))):
-                x_axis.append(reponse_time.timestamp)
-                y_axis.append(reponse_time.rtt)
-
-            graphs.append(
-                create_timestamp_graph(x_axis=x_axis,
-                                       y_axis=y_axis,
-                                       x_axis_name="Timestamp",
-                                       y_axis_name="RTT m/s",
-                                       title=f"Response Time (8h) - {cubicle.name}")
-                        )
-
-            val['graphs'] = graphs
-        case _:
-            return render_template('admin/modal/error.html')
+    graphs = list_graphs(_type, DEFAULT_TIME_RANGE, _id)
+    if not graphs:
+        return render_template('admin/modal/error.html')
 
+    val = {
+        'graphs': [_graph_url(g) for g in graphs],
+    }
     return render_template('admin/modal/measurement.html', obj=val)
 
 @admin.route('/generate-qr/<_id>', methods=['GET'])
@@ -751,102 +699,72 @@ def measurement():
     """ Measurement route for admin GUI """
 
     # If cookie is present, use it. otherwise, set 8 hours as default.
-    if "divisora_graphtimerange" in request.cookies:
-        time_range = request.cookies.get('divisora_graphtimerange')
-    else:
-        time_range = 8
-
-    # Verify that time_range cookie really is an integer
-    if not isinstance(time_range, int):
-        try:
-            time_range = int(time_range)
-        except (TypeError, ValueError):
-            # Default to 8 hours if no value can be parsed
-            time_range = 8
-
-    # If the value deviate from our fixde range, set it to 8 hours
-    if time_range not in [4, 8, 24, 48, 168]:
-        time_range = 8
-
-    graphs = []
-
-    # Cubicles
-    cubicles = db.session.execute(db.select(Cubicle.id, Cubicle.name)).all()
-    for cubicle_id, cubicle_name, in cubicles:
-        x_axis = []
-        y_axis = []
-        for response_time, in db.session.execute(db.select(ResponseTimeCubicle)
-                                                 # pylint: disable=C0301:line-too-long
-                                                 .where(ResponseTimeCubicle.cubicle_id == cubicle_id)
-                                                 # pylint: disable=C0301:line-too-long
-                                                 .where(ResponseTimeCubicle.timestamp > (datetime.now() - timedelta(hours=time_range)))
-                                                 ).all():
-            # Pad the beginning if response times are "missing"
-            if len(x_axis) < 1:
-                compare_time = datetime.now()
-                while response_time.timestamp < compare_time:
-                    x_axis.append(compare_time)
-                    y_axis.append(0.0)
-                    compare_time -= timedelta(minutes=1)
-            else:
-                # Check if we have a time-gap
-                # If there is a gap, padd values until the gap is less than a minute
-                compare_time = x_axis[-1:][0] - timedelta(minutes=1)
-                while response_time.timestamp < compare_time:
-                    x_axis.append(compare_time)
-                    y_axis.append(0.0)
-                    compare_time -= timedelta(minutes=1)
-
-            x_axis.append(response_time.timestamp)
-            y_axis.append(response_time.rtt)
-
-        graphs.append(
-            create_timestamp_graph(x_axis=x_axis,
-                                   y_axis=y_axis,
-                                   x_axis_name="Timestamp",
-                                   y_axis_name="RTT m/s",
-                                   title=f"Response Time ({time_range}h) - {cubicle_name}")
-                    )
-
-    # Nodes
-    nodes = db.session.execute(db.select(Node.id, Node.name)).all()
-    for node_id, node_name, in nodes:
-        x_axis = []
-        y_axis = []
-        for response_time, in db.session.execute(db.select(ResponseTimeNode)
-                                                 # pylint: disable=C0301:line-too-long
-                                                 .where(ResponseTimeNode.node_id == node_id)
-                                                 # pylint: disable=C0301:line-too-long
-                                                 .where(ResponseTimeNode.timestamp > (datetime.now() - timedelta(hours=time_range)))
-                                                 ).all():
-            # Pad the beginning if response times are "missing"
-            if len(x_axis) < 1:
-                compare_time = datetime.now()
-                while response_time.timestamp < compare_time:
-                    x_axis.append(compare_time)
-                    y_axis.append(0.0)
-                    compare_time -= timedelta(minutes=1)
-            else:
-                # Check if we have a time-gap
-                # If there is a gap, padd values until the gap is less than a minute
-                compare_time = x_axis[-1:][0] - timedelta(minutes=1)
-                while response_time.timestamp < compare_time:
-                    x_axis.append(compare_time)
-                    y_axis.append(0.0)
-                    compare_time -= timedelta(minutes=1)
-
-            x_axis.append(response_time.timestamp)
-            y_axis.append(response_time.rtt)
-
-        graphs.append(
-            create_timestamp_graph(x_axis=x_axis,
-                                   y_axis=y_axis,
-                                   x_axis_name="Timestamp",
-                                   y_axis_name="RTT m/s",
-                                   title=f"Response Time ({time_range}h) - {node_name}")
-                    )
-
-    return render_template('admin/measurements.html', time_range=time_range, graphs=graphs)
+    # Values that deviate from our fixed range are also set to 8 hours
+    time_range = parse_time_range(request.cookies.get('divisora_graphtimerange', DEFAULT_TIME_RANGE))
+
+    graphs = list_graphs('cubicle', time_range) + list_graphs('node', time_range)
+
+    # Graphs are served by graph(). Render those not cached yet while the page loads
+    graph_cache.prefetch(graphs)
+
+    return render_template('admin/measurements.html', time_range=time_range, graphs=[_graph_url(g) for g in graphs])
+
+@admin.route('/graph/<_type>/<int:_id>', methods=['GET'])
+def graph(_type, _id):
+    """ Rendered graph (PNG) of a cubicle or node. ?hours=<time range>, ?v=<version> """
+    if _type not in GRAPH_SOURCES:
+        return _modal_status_message('error', 'Unknown graph'), 404
+
+    graphs = list_graphs(_type, parse_time_range(request.args.get('hours')), _id)
+    if not graphs:
+        return _modal_status_message('error', 'Unknown graph'), 404
+
+    response = Response(graph_cache.render(graphs[0]), mimetype='image/png')
+    response.set_etag(graphs[0].key)
+    # The URL changes with the version, so a graph can be cached until it is rendered again
+    response.cache_control.private = True
+    response.cache_control.max_age = GRAPH_CACHE_TTL
+    return response.make_conditional(request)
+
+@admin.route('/series/<_type>/<int:_id>', methods=['GET'])
+def series(_type, _id):
+    """
+    Response times of a cubicle or node as columnar JSON for charts drawn by the browser.
+    ?hours=<time range>, ?width=<points, e.g. the chart width in pixels>, ?method=lttb|minmax
+    """
+    if _type not in SAMPLE_SOURCES:
+        return {'error': 'Unknown series'}, 404
+    name = entity_name(_type, _id)
+    if name is None:
+        return {'error': 'Unknown series'}, 404
+
+    hours = parse_time_range(request.args.get('hours'))
+    width = max(4, min(request.args.get('width', SERIES_DEFAULT_WIDTH, type=int), SERIES_MAX_WIDTH))
+    method = request.args.get('method', LTTB)
+    if method not in DOWNSAMPLE_METHODS:
+        return {'error': f"Unknown method, use one of {', '.join(DOWNSAMPLE_METHODS)}"}, 400
+
+    epochs, rtts = load_samples(_type, _id, datetime.utcnow() - timedelta(hours=hours))
+    total = len(epochs)
+    epochs, rtts = downsample(epochs, rtts, width, method)
+
+    response = jsonify({
+        'type': _type,
+        'id': _id,
+        'name': name,
+        'hours': hours,
+        'method': method,
+        'total': total,
+        'no': len(epochs),
+        't': epochs,
+        'rtt': rtts,
+    })
+    response.add_etag()
+    response.cache_control.private = True
+    return response.make_conditional(request)
+
+def _graph_url(_graph) -> str:
+    return url_for('admin.graph', _type=_graph.kind, _id=_graph.entity_id, hours=_graph.hours, v=_graph.version)
 
 def _modal_status_message(status, text):
     return render_template('admin/modal/status.html', info={
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tables of the admin overview
+
+Every table is one column-projected query, paged, sorted and filtered by the database.
+The parameters of a table are prefixed with its name, e.g. ?users_page=2&users_sort=name
+&users_order=desc&users_q=adm&users_status=online, so the tables page independently.
+"""
+
+from datetime import datetime, timedelta
+from math import ceil
+from typing import Callable
+
+from flask import url_for
+from sqlalchemy import case, func, or_, select, and_
+from sqlalchemy.sql import Select
+from werkzeug.datastructures import MultiDict
+
+from app.config import ADMIN_PAGE_SIZE
+from app.extensions import db
+
+from app.models.cubicle import Cubicle
+from app.models.image import Image
+from app.models.network import Network
+from app.models.node import Node
+from app.models.user import User
+
+ONLINE = "online"
+IDLE = "idle"
+OFFLINE = "offline"
+
+# (offline after, idle after) without activity
+USER_ACTIVITY = (timedelta(hours=1), timedelta(minutes=1))
+NODE_ACTIVITY = (timedelta(minutes=3), timedelta(minutes=1))
+
+def activity_status(column, offline_after: timedelta, idle_after: timedelta):
+    """ SQL expression giving ONLINE, IDLE or OFFLINE from a last_activity column """
+    now = datetime.utcnow()
+    # pylint: disable-next=C0121:singleton-comparison
+    return case((column == None, OFFLINE),
+                (column < now - offline_after, OFFLINE),
+                (column < now - idle_after, IDLE),
+                else_=ONLINE)
+
+def status_of(last_activity: datetime|None, offline_after: timedelta, idle_after: timedelta) -> str:
+    """ ONLINE, IDLE or OFFLINE of a last_activity value, the same as activity_status() """
+    now = datetime.utcnow()
+    if last_activity is not None and last_activity.tzinfo is not None:
+        last_activity = last_activity.replace(tzinfo=None)
+    if last_activity is None or last_activity < now - offline_after:
+        return OFFLINE
+    if last_activity < now - idle_after:
+        return IDLE
+    return ONLINE
+
+def user_status():
+    """ Status of a user """
+    return activity_status(User.last_activity, *USER_ACTIVITY)
+
+def node_status():
+    """ Status of a node, from when it last called the API """
+    return activity_status(Node.last_activity, *NODE_ACTIVITY)
+
+def parse_bool(value: str) -> bool|None:
+    """ 'true'/'false' (or 1/0, yes/no) from a query string, else None """
+    value = value.lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    return None
+
+class Table():
+    """
+    A table of the overview. 'query()' returns the projected select, 'columns' maps a sort
+    key to its column, 'search' are the columns matched by ?<name>_q and 'filters' maps a
+    filter key to a function giving the criterion for a value (or None to ignore it)
+    """
+
+    def __init__(self, name: str, query: Callable[[], Select], key, columns: dict, sort: str,
+                 search: tuple = (), filters: dict|None = None, page_size: int = ADMIN_PAGE_SIZE):
+        self.name = name
+        self.query = query
+        self.key = key
+        self.columns = columns
+        self.sort = sort
+        self.search = search
+        self.filters = filters or {}
+        self.page_size = page_size
+
+    def param(self, key: str) -> str:
+        """ Name of a query string parameter of this table """
+        return f"{self.name}_{key}"
+
+    def page(self, args: MultiDict) -> "TablePage":
+        """ The page of the table asked for by the query string 'args' """
+        sort = args.get(self.param("sort"), self.sort)
+        if sort not in self.columns:
+            sort = self.sort
+        order = "desc" if args.get(self.param("order")) == "desc" else "asc"
+        search = args.get(self.param("q"), "").strip()
+
+        criteria = []
+        if search and self.search:
+            criteria.append(or_(*[column.ilike(f"%{search}%") for column in self.search]))
+        filters = {}
+        for key, criterion in self.filters.items():
+            value = args.get(self.param(key), "")
+            if value and (clause := criterion(value)) is not None:
+                criteria.append(clause)
+                filters[key] = value
+
+        stmt = self.query().where(*criteria)
+        total = db.session.execute(select(func.count()).select_from(stmt.order_by(None).subquery())).scalar()
+        pages = max(1, ceil(total / self.page_size))
+        number = min(max(1, args.get(self.param("page"), 1, type=int) or 1), pages)
+
+        column = self.columns[sort]
+        stmt = (
+            stmt.order_by(column.desc() if order == "desc" else column.asc(), self.key)
+            .limit(self.page_size)
+            .offset((number - 1) * self.page_size)
+        )
+        rows = [row._asdict() for row in db.session.execute(stmt)]
+        return TablePage(self, args, rows, total, number, pages, sort, order, search, filters)
+
+class TablePage():
+    """ One page of a table, with links to other pages and orders """
+
+    def __init__(self, table: Table, args: MultiDict, rows: list[dict], total: int, page: int, pages: int,
+                 sort: str, order: str, search: str, filters: dict):
+        self.table = table
+        self.args = args
+        self.rows = rows
+        self.total = total
+        self.page = page
+        self.pages = pages
+        self.sort = sort
+        self.order = order
+        self.search = search
+        self.filters = filters
+        self.first = (page - 1) * table.page_size + 1 if rows else 0
+        self.last = (page - 1) * table.page_size + len(rows)
+
+    def param(self, key: str) -> str:
+        """ Name of a query string parameter of the table """
+        return self.table.param(key)
+
+    def url(self, **changes) -> str:
+        """ URL of the overview with the parameters of this table changed """
+        args = self.args.to_dict()
+        for key, value in changes.items():
+            args[self.param(key)] = value
+        return url_for('admin.main', **{k: v for k, v in args.items() if v not in (None, "")})
+
+    def sort_url(self, key: str) -> str:
+        """ URL ordering the table by 'key', reversing the order if it already is """
+        order = "desc" if key == self.sort and self.order == "asc" else "asc"
+        return self.url(sort=key, order=order, page=None)
+
+    def hidden(self) -> list[tuple[str, str]]:
+        """ Parameters to keep when the filter form of the table is submitted """
+        own = {self.param("page"), self.param("q")} | {self.param(key) for key in self.table.filters}
+        return [(key, value) for key, value in self.args.to_dict().items() if key not in own]
+
+def _users():
+    return select(User.id, User.name, User.username, User.admin, User.last_activity)
+
+def _nodes():
+    return select(Node.id, Node.name, Node.ip_address.label("ip"), Node.network_range, Node.response_time,
+                  Node.status, Node.last_activity)
+
+def _images():
+    return select(Image.id, Image.name, Image.image.label("source"), Image.cpu_limit, Image.mem_limit)
+
+def _cubicles():
+    # First network of the owner on the node of the cubicle
+    first_network = (
+        select(func.min(Network.id).label("id"), Network.user_id, Network.node_id)
+        .group_by(Network.user_id, Network.node_id)
+        .subquery()
+    )
+    return (
+        select(Cubicle.id, Cubicle.name, Cubicle.user_id, User.name.label("user"), Image.name.label("image"),
+               Node.name.label("node"), Cubicle.novnc_port, Cubicle.response_time,
+               Network.ip_range.label("network"), Cubicle.active)
+        .outerjoin(User, Cubicle.user_id == User.id)
+        .outerjoin(Image, Cubicle.image_id == Image.id)
+        .outerjoin(Node, Cubicle.node_id == Node.id)
+        .outerjoin(first_network, and_(first_network.c.user_id == Cubicle.user_id,
+                                       first_network.c.node_id == Cubicle.node_id))
+        .outerjoin(Network, Network.id == first_network.c.id)
+    )
+
+def _status_filter(status):
+    return lambda value: status() == value if value in (ONLINE, IDLE, OFFLINE) else None
+
+def _bool_filter(column):
+    def criterion(value):
+        value = parse_bool(value)
+        return None if value is None else column == value
+    return criterion
+
+users_table = Table(
+    "users", _users, User.id,
+    columns={"id": User.id, "username": User.username, "name": User.name, "admin": User.admin,
+             "status": User.last_activity},
+    sort="id",
+    search=(User.username, User.name),
+    filters={"status": _status_filter(user_status), "admin": _bool_filter(User.admin)},
+)
+
+nodes_table = Table(
+    "nodes", _nodes, Node.id,
+    columns={"name": Node.name, "address": Node.ip_address, "rtt": Node.response_time,
+             "status": Node.last_activity},
+    sort="name",
+    search=(Node.name, Node.domain_name),
+    filters={"status": _status_filter(node_status)},
+)
+
+images_table = Table(
+    "images", _images, Image.id,
+    columns={"name": Image.name, "source": Image.image, "cpu_limit": Image.cpu_limit,
+             "mem_limit": Image.mem_limit},
+    sort="name",
+    search=(Image.name, Image.image),
+)
+
+cubicles_table = Table(
+    "cubicles", _cubicles, Cubicle.id,
+    columns={"name": Cubicle.name, "user": User.name, "image": Image.name, "network": Network.ip_range,
+             "node": Node.name, "novnc_port": Cubicle.novnc_port, "active": Cubicle.active,
+             "rtt": Cubicle.response_time},
+    sort="name",
+    search=(Cubicle.name, User.name, Node.name),
+    filters={"active": _bool_filter(Cubicle.active)},
+)
@@ -1,114 +1,197 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, request
+from flask import Blueprint, Response, request, g, jsonify
 from flask_login import login_required
-from sqlalchemy import and_
-
-from datetime import datetime, timedelta
+from sqlalchemy import select
 
 from app.models.network import Network
 from app.models.cubicle import Cubicle
+from app.models.image import Image
 from app.models.node import Node
+from app.models.user import User
+from app.models.revision import CHANGE_ADDED, current_revision, oldest_revision, changes_since
+from app.models.report import parse_report, ingest_report
 
 from app.extensions import db
+from app.activity.tracker import activity_tracker
+from app.cache.nodes import node_id_by_ip, node_id_by_api_key
+from app.cache.snapshots import node_snapshot, network_snapshot
+from app.config import SNAPSHOT_PAGE_SIZE
 
 api = Blueprint('api', __name__)
 
-@api.before_request
-def update_last_activity():
+# Header used by node agents to identify themselves
+API_KEY_HEADER = 'X-API-Key'
+
+def resolve_node_id():
+    """ Node calling the API, from its API key or else from its IP address """
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key:
+        return node_id_by_api_key(api_key)
+
     real_ip = request.headers.get('X-Real-IP')
     if not real_ip:
         real_ip = request.remote_addr
+    return node_id_by_ip(real_ip)
 
-    node = Node.query.filter_by(ip_address=real_ip).first()
-    if not node:
+@api.before_request
+def update_last_activity():
+    g.node_id = resolve_node_id()
+    if not g.node_id:
         return
-    
-    node.last_activity = datetime.utcnow()
 
-    try:
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
-    else:
-        print("Updated last activity timer for {}".format(node.name))
+    # Written in bulk by the activity tracker
+    activity_tracker.touch_node(g.node_id)
 
 @api.route('/')
 def api_main():
     return {}
 
+def select_cubicles(*criteria):
+    """ Cubicles as served by the feed: (node_id, name, image, network, node, novnc_port, owner) """
+    # First network of the owner on the same node as the cubicle
+    network = (
+        select(Network.name)
+        .where(Network.user_id == Cubicle.user_id, Network.node_id == Cubicle.node_id)
+        .order_by(Network.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+    # Only return values for those cubicles who have a active owner.
+    # Idle cubicles are deactivated by the scheduled task reap_idle_cubicles
+    return (
+        select(Cubicle.node_id, Cubicle.name, Image.image, network, Node.name, Cubicle.novnc_port, User.username)
+        .join(User, Cubicle.user_id == User.id)
+        .outerjoin(Image, Cubicle.image_id == Image.id)
+        .outerjoin(Node, Cubicle.node_id == Node.id)
+        .where(Cubicle.active == True, *criteria)
+        .order_by(Cubicle.id)
+    )
+
+def cubicle_json(name, image, network, node, novnc_port, owner):
+    """ A cubicle in the feed """
+    return {
+        'name': name,
+        'image': image,
+        'network': network,
+        'node': node,
+        'novnc_port': novnc_port,
+        'owner': owner,
+    }
+
 @api.route('/cubicle')
 def api_cubicle():
+    """
+    Active cubicles. A node agent (identified by API key or IP address) only gets its
+    own cubicles. With ?since=<revision> it only gets what was added, changed or removed
+    since that revision, or 304 if nothing was.
+    """
+    node_id = g.get('node_id')
+    criteria = [Cubicle.node_id == node_id] if node_id else []
+
+    # Read before the cubicles, so a change in between is sent again rather than missed
+    revision = current_revision()
+    since = request.args.get('since', type=int)
+    if node_id and since is not None and oldest_revision() - 1 <= since <= revision:
+        return cubicle_delta(node_id, since, revision)
+
     ret = {
         'no': 0,
+        'revision': revision,
         'result': [],
     }
-
-    # Only return values for those cubicles who have a active owner.
-    for cubicle in Cubicle.query.filter(and_(Cubicle.user_id != None, Cubicle.active == True)).all():
-        # Ignore cubicles where the user have been idle for more than 1 hour
-        # TODO: Set this variable (hours=1) somewhere else.
-        if cubicle.user.last_activity < datetime.utcnow() - timedelta(hours=1):
-            cubicle.active = False
-            try:
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-            else:
-                print("Removed cubicle '{}' from active state through API refresh".format(cubicle.name))
-            continue
-
-        network = None
-        for n in cubicle.user.networks:
-            if n.node.id != cubicle.node.id:
-                continue
-            network = n.name
-            break
-
-        ret['result'].append({
-            'name': cubicle.name,
-            'image': cubicle.image.image,
-            'network': network,
-            'node': cubicle.node.name,
-            'novnc_port': cubicle.novnc_port,
-            'owner': cubicle.user.username,
-        })
+    for _, *cubicle in db.session.execute(select_cubicles(*criteria)):
+        ret['result'].append(cubicle_json(*cubicle))
 
     ret['no'] = len(ret['result'])
     return ret
 
-@api.route('/network')
-def api_network():
+def cubicle_delta(node_id: int, since: int, revision: int):
+    """ Cubicles added, changed or removed on a node after revision 'since' """
+    changes = changes_since(since, node_id)
+    if not changes:
+        return '', 304
+
+    names = {name for _, name in changes}
+    current = {}
+    for _, *cubicle in db.session.execute(select_cubicles(Cubicle.node_id == node_id, Cubicle.name.in_(names))):
+        current[cubicle[0]] = cubicle_json(*cubicle)
+
     ret = {
         'no': 0,
-        'result': [],
+        'revision': revision,
+        'since': since,
+        'added': [],
+        'changed': [],
+        'removed': [],
     }
-    for n in Network.query.all():
-        ret['result'].append({
-            'name': n.name,
-            'range': str(n.ip_range),
-            'node': n.node.name,
-            'owner': n.user.name if n.user != None else '',
+    for _, name in sorted(changes):
+        if name not in current:
+            ret['removed'].append(name)
+        elif CHANGE_ADDED in changes[(node_id, name)]:
+            ret['added'].append(current[name])
+        else:
+            ret['changed'].append(current[name])
+
+    ret['no'] = len(ret['added']) + len(ret['changed']) + len(ret['removed'])
+    return ret
+
+@api.route('/report', methods=['POST'])
+def api_report():
+    """
+    Status report pushed by a node agent: its running cubicles, networks and RTT samples.
+    The node is identified by its API key (X-API-Key). See parse_report() for the format
+    """
+    node_id = node_id_by_api_key(request.headers.get(API_KEY_HEADER))
+    if not node_id:
+        return {'error': 'Unknown or missing API key'}, 401
+
+    try:
+        report = parse_report(request.get_json(silent=True))
+    except ValueError as _err:
+        return {'error': f"{_err}"}, 400
+
+    return ingest_report(node_id, report)
+
+def serve_snapshot(snapshot):
+    """
+    Serve a snapshot with ETag / If-None-Match. With ?limit=<n> one page is returned,
+    and 'next' is the cursor for the following page (?cursor=<next>)
+    """
+    view = snapshot.get()
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        response = Response(view.body, mimetype='application/json')
+    else:
+        limit = max(1, min(limit, SNAPSHOT_PAGE_SIZE))
+        cursor = request.args.get('cursor', '')
+        offset = 0
+        if cursor:
+            # Cursors are only valid for the version they were created for
+            version, _, offset = cursor.partition('.')
+            if version != view.etag[:12] or not offset.isdigit():
+                return {'error': 'Cursor is no longer valid, start over'}, 410
+            offset = int(offset)
+
+        items = view.items[offset:offset + limit]
+        next_offset = offset + len(items)
+        response = jsonify({
+            'no': len(items),
+            'total': len(view.items),
+            'result': items,
+            'next': f"{view.etag[:12]}.{next_offset}" if next_offset < len(view.items) else None,
         })
 
-    ret['no'] = len(ret['result'])
-    return ret
+    response.set_etag(view.etag)
+    response.headers['X-Snapshot-Version'] = str(view.version)
+    return response.make_conditional(request)
+
+@api.route('/network')
+def api_network():
+    return serve_snapshot(network_snapshot)
 
 @api.route('/node')
 def api_node():
-    ret = {
-        'no': 0,
-        'result': [],
-    }
-    for n in Node.query.all():
-        ret['result'].append({
-            'name': n.name,
-            'cubicle_range': str(n.network_range),
-            'ip_address': str(n.ip_address),
-            'cubicles': [c.name for c in n.cubicles],
-            'networks': [str(net.ip_range) for net in n.networks]
-        })
-
-    ret['no'] = len(ret['result'])
-    return ret
\ No newline at end of file
+    return serve_snapshot(node_snapshot)
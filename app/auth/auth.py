@@ -4,7 +4,6 @@
 """ Blueprint for Auth """
 
 from urllib.parse import urlparse, parse_qs, urlunparse, urlencode
-from datetime import datetime
 
 import time
 import pyotp
@@ -19,28 +18,33 @@ from sqlalchemy import and_
 from app.extensions import db
 from app.extensions import login_manager
 from app.extensions import logger
+from app.activity.tracker import activity_tracker
+from app.auth.principal import load_principal
 
 from app.models.user import User
 #from app.models.node import Node
 from app.models.cubicle import Cubicle
+from app.tasks.schedule import request_reconcile
 
 auth = Blueprint('auth', __name__, template_folder='templates')
 
 @login_manager.user_loader
 def load_user(user_id):
-    """ Load user object """
-    if user_id is not None:
-        return User.query.get(user_id)
-    return None
+    """ Load lightweight principal. The full User is available through .user """
+    if user_id is None:
+        return None
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    return load_principal(user_id)
 
 @auth.before_request
 def update_last_activity():
     """ Update the last time a user were active """
     if not current_user.is_authenticated:
         return
-    user = User.query.filter_by(id=current_user.id).first()
-    user.last_activity = datetime.utcnow()
-    db.session.commit()
+    activity_tracker.touch_user(current_user.id)
 
 # This method is obselete for measurements
 # NoVNC have javacript calling this to not timeout sessions
@@ -175,9 +179,11 @@ def logout():
     # current_user.active = False
     #current_user.last_activity = datetime.utcnow() - timedelta(hours=1)
 
-    # pylint: disable=C0301:line-too-long
-    for cubicle in Cubicle.query.filter(and_(Cubicle.user_id == current_user.id, Cubicle.active is True)):
+    deactivated = {}
+    # pylint: disable=C0301:line-too-long,C0121:singleton-comparison
+    for cubicle in Cubicle.query.filter(and_(Cubicle.user_id == current_user.id, Cubicle.active == True)):
         cubicle.active = False
+        deactivated.setdefault(cubicle.node_id, []).append(cubicle.name)
         logger.info(f"Removed cubicle '{cubicle.name}' from active state")
 
     try:
@@ -185,6 +191,9 @@ def logout():
     # pylint: disable=W0718:broad-exception-caught
     except Exception:
         db.session.rollback()
+    else:
+        for node_id, names in deactivated.items():
+            request_reconcile(node_id, names)
 
     # Logout the user
     logout_user()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight principal used as 'current_user'
+
+Loading the full User would also join cubicles, networks and the whole event log on
+every request. The principal only holds the columns needed by most request handlers,
+and loads the ORM User on demand through Principal.user.
+"""
+
+from flask import session
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from app.config import PRINCIPAL_CACHE_TTL
+from app.extensions import db
+
+from app.cache.ttl import TTLCache
+from app.cache.upstream import get_upstream_novnc, has_relevant_changes
+from app.models.cubicle import Cubicle
+from app.models.user import User
+
+# user_id -> (id, username, name, admin)
+principal_cache = TTLCache(ttl=PRINCIPAL_CACHE_TTL)
+
+class Principal(UserMixin):
+    """ Authenticated user without any relationships loaded """
+
+    def __init__(self, _id: int, username: str, name: str, admin: bool):
+        self.id = _id
+        self.username = username
+        self.name = name
+        self.admin = admin
+        self._user = None
+
+    @property
+    def active_cubicle_id(self) -> int|None:
+        """ Id of the cubicle choosen in this session """
+        return session.get("cubicle_id")
+
+    @property
+    def user(self) -> User|None:
+        """ Full ORM User. Only load this when it is really needed """
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+        return self._user
+
+    def set_active_cubicle(self, cubicle_id: int = None) -> bool:
+        """ Set id for the active cubicle """
+        owner_id = db.session.execute(db.select(Cubicle.user_id)
+                                      .where(Cubicle.id == cubicle_id)
+                                      ).scalar()
+        if owner_id is None or owner_id != self.id:
+            return False
+
+        session["cubicle_id"] = cubicle_id
+        return True
+
+    def get_upstream_novnc(self) -> str:
+        """ Get the upstream adress to the NoVNC """
+        return get_upstream_novnc(self.id, self.active_cubicle_id)
+
+    def __repr__(self):
+        return f'<Principal "{self.username}", Admin "{self.admin}">'
+
+def load_principal(user_id: int) -> Principal|None:
+    """ Load principal for user_id, from cache if possible """
+    row = principal_cache.get(user_id)
+    if row is None:
+        row = db.session.execute(db.select(User.id, User.username, User.name, User.admin)
+                                 .where(User.id == user_id)
+                                 ).first()
+        if row is None:
+            return None
+        row = tuple(row)
+        principal_cache.set(user_id, row)
+
+    return Principal(*row)
+
+@event.listens_for(User, "after_update")
+def _user_updated(_, __, target):
+    if has_relevant_changes(target, {"last_activity"}):
+        principal_cache.delete(target.id)
+
+@event.listens_for(User, "after_delete")
+def _user_deleted(_, __, target):
+    principal_cache.delete(target.id)
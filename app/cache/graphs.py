@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache of rendered response time graphs (PNG)
+
+A graph is keyed by (entity, time range, timestamp of its last sample, render window of
+GRAPH_CACHE_TTL seconds), so it is only rendered again when new samples arrive or the
+time range has moved on to the next window. The key is also its version in the URL and
+its ETag, so browsers fetch the graph again whenever it is rendered again. Graphs are
+kept in a size-bounded LRU per process and, if enabled, in Redis so all web workers
+share them. Pages link to the graphs by URL. Graphs missing from the cache are rendered
+in the background while the page loads.
+"""
+
+import calendar
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Callable, NamedTuple
+
+import numpy as np
+import redis
+from flask import Flask, current_app
+from sqlalchemy import func, select
+
+from app.config import GRAPH_CACHE_MAX_BYTES, GRAPH_CACHE_TTL, GRAPH_CACHE_REDIS, GRAPH_RENDER_WORKERS
+from app.extensions import db, logger
+
+from app.models.measurements import render_timestamp_graph
+from app.models.timeseries import RttSample
+from app.timeseries.samples import SOURCES, load_series
+from app.timeseries.resample import FILL_ZERO, resample, to_datetime64
+from app.tasks.locks import KEY_PREFIX, get_redis
+
+# Time ranges (hours) that can be shown
+TIME_RANGES = [4, 8, 24, 48, 168]
+DEFAULT_TIME_RANGE = 8
+
+EMPTY_SERIES = (np.empty(0), np.empty(0))
+
+# Seconds Redis is not asked again after an error
+REDIS_RETRY_AFTER = 60.0
+
+class Graph(NamedTuple):
+    """ A graph that can be shown """
+    kind: str
+    entity_id: int
+    name: str
+    hours: int
+    version: str
+
+    @property
+    def key(self) -> str:
+        """ Cache key """
+        return f"{self.kind}:{self.entity_id}:{self.hours}:{self.version}"
+
+class GraphCache():
+    """ LRU of rendered graphs, bounded to 'max_bytes', optionally backed by Redis """
+
+    def __init__(self, max_bytes: int = GRAPH_CACHE_MAX_BYTES, ttl: float = GRAPH_CACHE_TTL,
+                 workers: int = GRAPH_RENDER_WORKERS, use_redis: bool = GRAPH_CACHE_REDIS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.workers = workers
+        self.use_redis = use_redis
+        self._entries = OrderedDict() # key -> (expires, png)
+        self._size = 0
+        self._pending = {} # key -> Future
+        self._executor = None
+        self._redis_down_until = 0.0
+        self._lock = Lock()
+
+    def get(self, key: str) -> bytes|None:
+        """ Cached graph, from this process or else from Redis """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                self._drop(key)
+
+        png = self._redis_get(key)
+        if png is not None:
+            self._store(key, png)
+        return png
+
+    def set(self, key: str, png: bytes):
+        """ Cache a graph in this process and in Redis """
+        self._store(key, png)
+        self._redis_set(key, png)
+
+    def render(self, graph: Graph) -> bytes:
+        """ The graph, from the cache, from a background render or rendered now """
+        png = self.get(graph.key)
+        if png is not None:
+            return png
+        with self._lock:
+            future = self._pending.get(graph.key)
+        if future is not None:
+            return future.result()
+        png = render_graph(graph)
+        self.set(graph.key, png)
+        return png
+
+    def prefetch(self, graphs: list[Graph]):
+        """
+        Render the graphs not cached yet in the background. The samples of the missing
+        graphs are loaded with one query per worker and kind of graph
+        """
+        app = current_app._get_current_object() # pylint: disable=W0212:protected-access
+        groups = {}
+        with self._lock:
+            for graph in graphs:
+                entry = self._entries.get(graph.key)
+                if graph.key in self._pending or (entry is not None and entry[0] >= time.monotonic()):
+                    continue
+                self._pending[graph.key] = Future()
+                groups.setdefault((graph.kind, graph.hours), []).append(graph)
+            if groups and self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="graph-render")
+
+        for group in groups.values():
+            size = -(-len(group) // self.workers)
+            for first in range(0, len(group), size):
+                self._executor.submit(self._render_in_background, app, group[first:first + size])
+
+    def clear(self):
+        """ Remove all graphs of this process """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _render_in_background(self, app: Flask, graphs: list[Graph]):
+        """ Render graphs of the same kind and time range """
+        with app.app_context():
+            now = datetime.utcnow()
+            try:
+                series = load_series(graphs[0].kind, now - timedelta(hours=graphs[0].hours),
+                                     [graph.entity_id for graph in graphs])
+            # pylint: disable=W0718:broad-exception-caught
+            except Exception as _error:
+                logger.warning(f"Could not load samples of {len(graphs)} graph(s): {_error}")
+                series = None
+
+            for graph in graphs:
+                with self._lock:
+                    future = self._pending.get(graph.key)
+                try:
+                    png = self.get(graph.key)
+                    if png is None:
+                        samples = None if series is None else series.get(graph.entity_id, EMPTY_SERIES)
+                        png = render_graph(graph, samples, now)
+                        self.set(graph.key, png)
+                    future.set_result(png)
+                # pylint: disable=W0718:broad-exception-caught
+                except Exception as _error:
+                    logger.warning(f"Could not render graph {graph.key}: {_error}")
+                    future.set_exception(_error)
+                finally:
+                    with self._lock:
+                        self._pending.pop(graph.key, None)
+
+    def _store(self, key: str, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, png)
+            self._size += len(png)
+            while self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def _redis_call(self, call: Callable[[redis.Redis], object]):
+        if not self.use_redis or time.monotonic() < self._redis_down_until:
+            return None
+        try:
+            return call(get_redis())
+        except redis.RedisError as _err:
+            logger.warning(f"Graph cache can not use Redis ({_err}). Retrying in {REDIS_RETRY_AFTER:.0f}s")
+            self._redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return None
+
+    def _redis_get(self, key: str) -> bytes|None:
+        return self._redis_call(lambda client: client.get(f"{KEY_PREFIX}:graph:{key}"))
+
+    def _redis_set(self, key: str, png: bytes):
+        self._redis_call(lambda client: client.set(f"{KEY_PREFIX}:graph:{key}", png, ex=int(self.ttl)))
+
+graph_cache = GraphCache()
+
+def parse_time_range(value) -> int:
+    """ Hours of a time range from a cookie or query string, DEFAULT_TIME_RANGE if not valid """
+    try:
+        hours = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_TIME_RANGE
+    return hours if hours in TIME_RANGES else DEFAULT_TIME_RANGE
+
+def list_graphs(kind: str, hours: int, entity_id: int|None = None) -> list[Graph]:
+    """ Graphs of every entity of 'kind' (or of one) with the version of their data. One query """
+    source = SOURCES[kind]
+    last_sample = (
+        select(RttSample.entity_id, func.max(RttSample.timestamp).label("timestamp"))
+        .where(RttSample.kind == source.kind)
+        .group_by(RttSample.entity_id)
+    )
+    if entity_id is not None:
+        last_sample = last_sample.where(RttSample.entity_id == entity_id)
+    last_sample = last_sample.subquery()
+
+    stmt = (
+        select(source.model.id, source.name, last_sample.c.timestamp)
+        .outerjoin(last_sample, last_sample.c.entity_id == source.model.id)
+        .order_by(source.model.id)
+    )
+    if entity_id is not None:
+        stmt = stmt.where(source.model.id == entity_id)
+
+    # Without new samples, a graph still changes as its time range moves on
+    window = int(time.time() // GRAPH_CACHE_TTL)
+    graphs = []
+    for _id, name, timestamp in db.session.execute(stmt):
+        version = f"{timestamp:%Y%m%d%H%M%S}-{window}" if timestamp is not None else f"0-{window}"
+        graphs.append(Graph(kind, _id, name or "", hours, version))
+    return graphs
+
+def load_response_times(graph: Graph, samples: tuple|None = None,
+                        now: datetime|None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Timestamps and RTTs of the graph, one per minute from its oldest sample. Minutes without
+    one are 0.0. 'samples' are the (epochs, RTTs) from load_series() if already loaded
+    """
+    now = now or datetime.utcnow()
+    if samples is None:
+        samples = load_series(graph.kind, now - timedelta(hours=graph.hours), [graph.entity_id])
+        samples = samples.get(graph.entity_id, EMPTY_SERIES)
+    times, values = resample(*samples, end=calendar.timegm(now.timetuple()), step=60, fill=FILL_ZERO)
+    return to_datetime64(times), values
+
+def render_graph(graph: Graph, samples: tuple|None = None, now: datetime|None = None) -> bytes:
+    """ Render the graph as PNG """
+    x_axis, y_axis = load_response_times(graph, samples, now)
+    return render_timestamp_graph(x_axis=x_axis,
+                                  y_axis=y_axis,
+                                  x_axis_name="Timestamp",
+                                  y_axis_name="RTT m/s",
+                                  title=f"Response Time ({graph.hours}h) - {graph.name}")
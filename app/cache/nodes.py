@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache for resolving the calling node (IP address / API key -> node id)
+
+The API looks up the calling node on every request. All nodes are loaded with one
+query into two maps, kept until the admin GUI adds, changes or removes a node, or
+until NODE_INDEX_TTL runs out (which picks up changes made by other processes).
+"""
+
+from ipaddress import ip_address
+
+from sqlalchemy import select
+
+from app.config import NODE_INDEX_TTL
+from app.extensions import db
+
+from app.cache.ttl import TTLCache
+from app.models.node import Node
+
+# "index" -> ({ip address: node id}, {api key: node id})
+node_index = TTLCache(ttl=NODE_INDEX_TTL, max_size=1)
+
+def _normalize_ip(value) -> str|None:
+    try:
+        return str(ip_address(str(value).strip()))
+    except ValueError:
+        return None
+
+def load_node_index() -> tuple[dict[str, int], dict[str, int]]:
+    """ Map IP addresses and API keys of all nodes to their id """
+    by_ip, by_api_key = {}, {}
+    for _id, _ip_address, api_key in db.session.execute(select(Node.id, Node.ip_address, Node.api_key)):
+        if _ip_address is not None:
+            by_ip.setdefault(_normalize_ip(_ip_address), _id)
+        if api_key:
+            by_api_key.setdefault(api_key, _id)
+    return by_ip, by_api_key
+
+def node_id_by_ip(value: str|None) -> int|None:
+    """ Id of the node with IP address 'value' """
+    if not value:
+        return None
+    by_ip, _ = node_index.get_or_set("index", load_node_index)
+    return by_ip.get(_normalize_ip(value))
+
+def node_id_by_api_key(api_key: str|None) -> int|None:
+    """ Id of the node with API key 'api_key' """
+    if not api_key:
+        return None
+    _, by_api_key = node_index.get_or_set("index", load_node_index)
+    return by_api_key.get(api_key)
+
+def invalidate_node_index():
+    """ Reload the nodes on the next lookup. Call when a node is added, changed or removed """
+    node_index.clear()
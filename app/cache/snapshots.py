@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Materialized JSON snapshots of the node topology (/api/node and /api/network)
+
+A snapshot is kept per process as one part per node plus the serialized response. When
+a node, network, cubicle or user changes, only the parts of the affected nodes are
+marked stale (after the commit) and rebuilt on the next request. The commit also bumps a
+version of the snapshot in Redis. The other processes compare it on every request and
+rebuild their snapshot when it moved. If Redis can not be reached, the whole snapshot is
+rebuilt after SNAPSHOT_TTL seconds, which picks up changes made by other processes.
+
+The ETag is a hash of the response, so every process gives the same ETag for the same
+content.
+"""
+
+import hashlib
+import json
+import time
+from threading import Lock
+from typing import Callable, NamedTuple
+
+import redis
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, object_session
+
+from app.config import SNAPSHOT_TTL
+from app.extensions import db, logger
+
+from app.models.cubicle import Cubicle
+from app.models.network import Network
+from app.models.node import Node
+from app.models.user import User
+from app.tasks.locks import KEY_PREFIX, get_redis
+
+# Seconds Redis is not asked again after an error
+REDIS_RETRY_AFTER = 60.0
+
+class SnapshotView(NamedTuple):
+    """ A built snapshot """
+    version: int
+    etag: str
+    body: bytes
+    items: list[dict]
+
+class Snapshot():
+    """
+    JSON list built from one part per node. 'loader(node_ids)' returns {node_id: [items]}
+    for the given nodes, or for all nodes if 'node_ids' is None.
+    """
+
+    def __init__(self, name: str, loader: Callable[[set|None], dict], ttl: float = SNAPSHOT_TTL):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self._parts = {}
+        self._stale = None # None means everything
+        self._view = None
+        self._built = 0.0
+        self._version = 0
+        self._shared = None # Version in Redis the snapshot was built for
+        self._redis_down_until = 0.0
+        self._lock = Lock()
+
+    def invalidate(self, node_ids: set|None = None):
+        """ Mark the parts of 'node_ids' (or everything) as stale """
+        with self._lock:
+            if node_ids is None or self._stale is None:
+                self._stale = None
+            else:
+                self._stale |= set(node_ids)
+
+    def publish(self):
+        """ Tell the other processes that the snapshot changed. Call after the commit """
+        shared = self._redis_call(lambda client: client.incr(self._shared_key()))
+        with self._lock:
+            # Only skip our own change. If another process changed it in between, the
+            # version is further ahead and the next get() rebuilds everything
+            if shared is not None and self._shared is not None and shared == self._shared + 1:
+                self._shared = shared
+
+    def get(self) -> SnapshotView:
+        """ The current snapshot, rebuilding stale parts first """
+        shared = self._redis_call(lambda client: int(client.get(self._shared_key()) or 0))
+        with self._lock:
+            if shared is not None and shared != self._shared:
+                # Changed by another process, which nodes is not known
+                self._stale = None
+                self._shared = shared
+
+            if self._view is not None and self._stale == set() and time.monotonic() - self._built < self.ttl:
+                return self._view
+
+            if self._view is None or self._stale is None or time.monotonic() - self._built >= self.ttl:
+                self._parts = self.loader(None)
+                self._built = time.monotonic()
+            else:
+                parts = self.loader(self._stale)
+                for node_id in self._stale:
+                    # A node without items is either empty or gone
+                    self._parts.pop(node_id, None)
+                self._parts.update(parts)
+            self._stale = set()
+
+            items = []
+            for node_id in sorted(self._parts, key=lambda k: (k is None, k or 0)):
+                items += self._parts[node_id]
+            body = json.dumps({'no': len(items), 'result': items}).encode("utf-8")
+            etag = hashlib.sha1(body).hexdigest()
+            if self._view is None or self._view.etag != etag:
+                self._version += 1
+            self._view = SnapshotView(self._version, etag, body, items)
+            return self._view
+
+    def _shared_key(self) -> str:
+        return f"{KEY_PREFIX}:snapshot:{self.name}:version"
+
+    def _redis_call(self, call: Callable[[redis.Redis], object]):
+        if time.monotonic() < self._redis_down_until:
+            return None
+        try:
+            return call(get_redis())
+        except (redis.RedisError, RuntimeError) as _err:
+            # RuntimeError: outside of an app context
+            logger.warning(f"Snapshot {self.name} can not use Redis ({_err}). Retrying in {REDIS_RETRY_AFTER:.0f}s")
+            self._redis_down_until = time.monotonic() + REDIS_RETRY_AFTER
+            return None
+
+def load_nodes(node_ids: set|None) -> dict[int, list[dict]]:
+    """ /api/node items per node """
+    def scoped(stmt, column):
+        return stmt if node_ids is None else stmt.where(column.in_(node_ids))
+
+    parts = {}
+    stmt = scoped(select(Node.id, Node.name, Node.network_range, Node.ip_address), Node.id)
+    for _id, name, network_range, _ip_address in db.session.execute(stmt.order_by(Node.id)):
+        parts[_id] = [{
+            'name': name,
+            'cubicle_range': str(network_range),
+            'ip_address': str(_ip_address),
+            'cubicles': [],
+            'networks': [],
+        }]
+
+    stmt = scoped(select(Cubicle.node_id, Cubicle.name), Cubicle.node_id)
+    for node_id, name in db.session.execute(stmt.order_by(Cubicle.id)):
+        if node_id in parts:
+            parts[node_id][0]['cubicles'].append(name)
+
+    stmt = scoped(select(Network.node_id, Network.ip_range), Network.node_id)
+    for node_id, ip_range in db.session.execute(stmt.order_by(Network.id)):
+        if node_id in parts:
+            parts[node_id][0]['networks'].append(str(ip_range))
+
+    return parts
+
+def load_networks(node_ids: set|None) -> dict[int, list[dict]]:
+    """ /api/network items per node """
+    stmt = (
+        select(Network.node_id, Network.name, Network.ip_range, Node.name, Network.user_id, User.name)
+        .outerjoin(Node, Network.node_id == Node.id)
+        .outerjoin(User, Network.user_id == User.id)
+        .order_by(Network.id)
+    )
+    if node_ids is not None:
+        stmt = stmt.where(Network.node_id.in_(node_ids))
+
+    parts = {}
+    for node_id, name, ip_range, node_name, user_id, owner in db.session.execute(stmt):
+        parts.setdefault(node_id, []).append({
+            'name': name,
+            'range': str(ip_range),
+            'node': node_name,
+            'owner': owner if user_id is not None else '',
+        })
+    return parts
+
+node_snapshot = Snapshot("node", load_nodes)
+network_snapshot = Snapshot("network", load_networks)
+
+# Stale node ids are collected per session during flush and applied after the commit,
+# so a concurrent rebuild never caches data that is not committed yet
+_STALE_KEY = "stale_snapshots"
+
+def _mark(target, snapshot: Snapshot, *node_ids):
+    session = object_session(target)
+    if session is None:
+        snapshot.invalidate(None)
+        return
+    stale = session.info.setdefault(_STALE_KEY, {})
+    stale.setdefault(snapshot.name, set()).update(node_ids)
+
+def _old_and_new(target, key: str) -> set:
+    history = inspect(target).attrs[key].history
+    return set(history.deleted) | {getattr(target, key)}
+
+def _changed(target, *keys) -> bool:
+    return any(inspect(target).attrs[key].history.has_changes() for key in keys)
+
+@event.listens_for(Session, "after_commit")
+def _apply_stale(session):
+    stale = session.info.pop(_STALE_KEY, None)
+    if not stale:
+        return
+    for snapshot in (node_snapshot, network_snapshot):
+        if snapshot.name in stale:
+            snapshot.invalidate(stale[snapshot.name])
+            snapshot.publish()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_stale(session):
+    session.info.pop(_STALE_KEY, None)
+
+@event.listens_for(Node, "after_insert")
+@event.listens_for(Node, "after_delete")
+def _node_added_or_deleted(_, __, target):
+    _mark(target, node_snapshot, target.id)
+    _mark(target, network_snapshot, target.id)
+
+@event.listens_for(Node, "after_update")
+def _node_updated(_, __, target):
+    if _changed(target, "name", "network_range", "ip_address"):
+        _mark(target, node_snapshot, target.id)
+    if _changed(target, "name"):
+        _mark(target, network_snapshot, target.id)
+
+@event.listens_for(Network, "after_insert")
+@event.listens_for(Network, "after_update")
+@event.listens_for(Network, "after_delete")
+def _network_changed(_, __, target):
+    node_ids = _old_and_new(target, "node_id")
+    _mark(target, node_snapshot, *node_ids)
+    _mark(target, network_snapshot, *node_ids)
+
+@event.listens_for(Cubicle, "after_insert")
+@event.listens_for(Cubicle, "after_delete")
+def _cubicle_added_or_deleted(_, __, target):
+    _mark(target, node_snapshot, target.node_id)
+
+@event.listens_for(Cubicle, "after_update")
+def _cubicle_updated(_, __, target):
+    if _changed(target, "name", "node_id"):
+        _mark(target, node_snapshot, *_old_and_new(target, "node_id"))
+
+@event.listens_for(User, "after_update")
+def _user_updated(_, __, target):
+    # The owner of a network is shown by name. Removed users are handled by the
+    # network listener, as their networks get user_id NULL
+    if _changed(target, "name"):
+        _mark(target, network_snapshot, *{network.node_id for network in target.networks})
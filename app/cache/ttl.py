@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Small thread-safe in-process cache with per-entry expiry """
+
+import time
+from threading import Lock
+from typing import Any, Callable, Hashable
+
+class TTLCache():
+    """
+    Dictionary-like cache where every entry expires after 'ttl' seconds.
+
+    Entries are only shared within the current process. Other workers keep their own
+    copy and rely on the TTL to pick up changes made elsewhere.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return the value for 'key', or 'default' if missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float|None = None):
+        """ Store 'value' for 'key' """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                self._purge_expired()
+                # Still full, drop the entry closest to expiry
+                if len(self._entries) >= self.max_size:
+                    oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                    del self._entries[oldest]
+            self._entries[key] = (time.monotonic() + ttl, value)
+
+    def get_or_set(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """ Return cached value for 'key' or load, store and return it """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def delete(self, key: Hashable):
+        """ Remove 'key' if present """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """ Remove every entry where predicate(key, value) is True """
+        with self._lock:
+            for key in [k for k, (_, v) in self._entries.items() if predicate(k, v)]:
+                del self._entries[key]
+
+    def clear(self):
+        """ Remove all entries """
+        with self._lock:
+            self._entries.clear()
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for key in [k for k, (expires, _) in self._entries.items() if expires < now]:
+            del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
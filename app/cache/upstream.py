@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache for the NoVNC upstream used by Nginx (auth_request -> /authenticate)
+
+Every proxied NoVNC request asks for the upstream. The answer rarely changes during
+a session, so it is kept per (user id, cubicle id) until the TTL runs out or until
+a cubicle, node or user row which the answer depends on is changed.
+"""
+
+from urllib.parse import urlparse, urlunparse
+
+from sqlalchemy import event, inspect
+
+from app.config import UPSTREAM_CACHE_TTL
+from app.extensions import db
+
+from app.cache.ttl import TTLCache
+from app.models.cubicle import Cubicle
+from app.models.node import Node
+
+# (user_id, cubicle_id) -> (url, node_id)
+upstream_cache = TTLCache(ttl=UPSTREAM_CACHE_TTL)
+
+# Columns that are updated frequently but never affect the upstream
+_IGNORED_COLUMNS = {
+    Cubicle: {"response_time"},
+    Node: {"last_activity", "status", "response_time"},
+}
+
+def resolve_upstream_novnc(user_id: int, cubicle_id: int) -> tuple[str, int]|None:
+    """ Build the upstream URL for a cubicle owned by user_id. Returns (url, node_id) """
+    stmt = (
+        db.select(Cubicle.insecure,
+                  Cubicle.novnc_name,
+                  Cubicle.novnc_port,
+                  Node.id,
+                  Node.domain_name,
+                  Node.ip_address)
+        .join(Node, Cubicle.node_id == Node.id)
+        .where(Cubicle.id == cubicle_id, Cubicle.user_id == user_id)
+    )
+    row = db.session.execute(stmt).first()
+    if row is None:
+        return None
+
+    insecure, novnc_name, novnc_port, node_id, domain_name, ip_address = row
+
+    scheme = "http" if insecure else "https"
+    if novnc_name:
+        netloc = novnc_name
+    else:
+        netloc = domain_name if domain_name else str(ip_address)
+    netloc += f":{novnc_port}"
+
+    return urlunparse(urlparse('')._replace(scheme=scheme, netloc=netloc)), node_id
+
+def get_upstream_novnc(user_id: int, cubicle_id: int|None) -> str:
+    """ Get the upstream adress to the NoVNC. Empty string if there is none """
+    if user_id is None or cubicle_id is None:
+        return ""
+
+    key = (user_id, cubicle_id)
+    entry = upstream_cache.get(key)
+    if entry is None:
+        entry = resolve_upstream_novnc(user_id, cubicle_id)
+        if entry is None:
+            return ""
+        upstream_cache.set(key, entry)
+
+    url, _ = entry
+    return url
+
+def evict_user(user_id: int):
+    """ Remove all cached upstreams for a user """
+    upstream_cache.delete_where(lambda key, _: key[0] == user_id)
+
+def evict_cubicle(cubicle_id: int):
+    """ Remove all cached upstreams pointing to a cubicle """
+    upstream_cache.delete_where(lambda key, _: key[1] == cubicle_id)
+
+def evict_node(node_id: int):
+    """ Remove all cached upstreams pointing to a node """
+    upstream_cache.delete_where(lambda _, value: value[1] == node_id)
+
+def has_relevant_changes(target, ignore: set) -> bool:
+    """ Check if any column, except those in 'ignore', was changed on target """
+    state = inspect(target)
+    for attr in state.mapper.column_attrs:
+        if attr.key in ignore:
+            continue
+        if state.attrs[attr.key].history.has_changes():
+            return True
+    return False
+
+@event.listens_for(Cubicle, "after_update")
+def _cubicle_updated(_, __, target):
+    if has_relevant_changes(target, _IGNORED_COLUMNS[Cubicle]):
+        evict_cubicle(target.id)
+
+@event.listens_for(Cubicle, "after_delete")
+def _cubicle_deleted(_, __, target):
+    evict_cubicle(target.id)
+
+@event.listens_for(Node, "after_update")
+def _node_updated(_, __, target):
+    if has_relevant_changes(target, _IGNORED_COLUMNS[Node]):
+        evict_node(target.id)
+
+@event.listens_for(Node, "after_delete")
+def _node_deleted(_, __, target):
+    evict_node(target.id)
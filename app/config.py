@@ -13,6 +13,85 @@ MIN_USERNAME_LENGTH = 2
 MIN_PASSWORD_LENGTH = 5
 CPU_LIMIT = 10
 
+# Rows per page in the tables of the admin overview
+ADMIN_PAGE_SIZE = 50
+
+# Rendered measurement graphs. A graph is rendered again when new samples arrive or
+# after GRAPH_CACHE_TTL seconds
+GRAPH_CACHE_TTL = 600
+GRAPH_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Per process, least recently used graphs are dropped first
+GRAPH_CACHE_REDIS = True      # Share rendered graphs between workers through Redis
+GRAPH_RENDER_WORKERS = 2      # Graphs rendered at the same time in the background
+
+# Response time samples are buffered and written in batches
+RTT_FLUSH_INTERVAL = 5        # Seconds between writes
+RTT_INGEST_BATCH = 5000       # Samples per INSERT. A full batch is written at once
+RTT_BUFFER_BATCHES = 20       # Batches kept while the database can not be written to
+
+# Points returned by /admin/series when no ?width= is given, and the most that may be asked for
+SERIES_DEFAULT_WIDTH = 800
+SERIES_MAX_WIDTH = 4000
+
+# Seconds a resolved NoVNC upstream (X-URL) is cached
+UPSTREAM_CACHE_TTL = 300
+
+# Seconds between bulk writes of last_activity for users and nodes
+ACTIVITY_FLUSH_INTERVAL = 15
+
+# Seconds the principal (current_user) of a session is cached
+PRINCIPAL_CACHE_TTL = 30
+
+# Seconds the IP address / API key -> node map used by the API is cached
+NODE_INDEX_TTL = 60
+
+# Seconds before the /api/node and /api/network snapshots are rebuilt from scratch. Changes
+# made by other processes are seen at once through Redis, this is the fallback without it
+SNAPSHOT_TTL = 300
+SNAPSHOT_PAGE_SIZE = 1000     # Max items per page with ?limit=
+
+# Node agent API client
+NODE_CONNECT_TIMEOUT = 2      # Seconds to open a connection
+NODE_READ_TIMEOUT = 2         # Seconds to wait for an answer
+NODE_CUBICLE_TIMEOUT = 10     # Seconds to wait for a cubicle to be started/removed
+NODE_RETRIES = 2              # Extra attempts on connection errors and 502/503/504
+NODE_RETRY_BACKOFF = 0.2      # Seconds before the first retry. Doubled per retry, with jitter
+NODE_POOL_SIZE = 4            # Idle keep-alive connections kept per node
+
+# Node health probing (check_all_nodes)
+NODE_PROBE_TIMEOUT = 2        # Seconds per node
+NODE_PROBE_WORKERS = 128      # Max number of nodes probed at the same time
+NODE_PROBE_DEADLINE = 4.0     # Seconds for the whole sweep. Keep below the beat interval
+
+# Backoff and circuit breaker for failing nodes. Healthy nodes are checked every cycle
+NODE_BACKOFF_BASE = 5.0       # Seconds to wait after the first failure. Doubled per failure, with jitter
+NODE_BACKOFF_MAX = 120.0      # Max seconds between checks while backing off
+NODE_BREAKER_THRESHOLD = 5    # Consecutive failures before the circuit opens
+NODE_BREAKER_OPEN_TIME = 600.0  # Seconds the circuit stays open before one trial check (half-open)
+
+# Seconds a status report pushed by a node (POST /api/report) is used instead of asking the node
+NODE_REPORT_MAX_AGE = 30
+
+# Node reconciliation (check_node_compliance)
+NODE_RECONCILE_WORKERS = 32   # Max number of nodes reconciled at the same time
+NODE_RECONCILE_DEADLINE = 60.0
+NODE_LOCK_TTL = 120           # Seconds a node may stay locked by one reconciliation
+NODE_ORPHAN_GRACE = 120.0     # Seconds a cubicle must be unwanted before it is removed
+NODE_DELETE_BATCH = 20        # Max cubicles removed from one node per reconciliation
+NODE_DELETE_WORKERS = 4       # Removals done at the same time on one node
+RECONCILE_NOW_RETRIES = 30    # Retries (1s apart) of reconcile_node_now while the node is locked
+
+# Seconds a user may be idle before their active cubicles are deactivated
+CUBICLE_IDLE_TIMEOUT = 3600
+
+# Seconds changes of the desired state are kept for delta requests (?since=) to the cubicle feed.
+# Agents with an older revision get the full list
+DESIRED_STATE_RETENTION = 86400
+
+# Beat intervals (seconds). A run taking longer than this is counted as overrun
+CHECK_ALL_NODES_INTERVAL = 5.0
+CHECK_NODE_COMPLIANCE_INTERVAL = 60.0
+REAP_IDLE_CUBICLES_INTERVAL = 60.0
+
 # pylint: disable-next=R0903:too-few-public-methods
 class Config():
     """ Base config class """
@@ -36,11 +115,20 @@ class Config():
         "beat_schedule": {
             'check_all_nodes': {
                 'task': 'app.tasks.schedule.check_all_nodes',
-                'schedule': 5.0,
-            },            
+                'schedule': CHECK_ALL_NODES_INTERVAL,
+                # Drop runs still queued when the next one is due
+                'options': {'expires': CHECK_ALL_NODES_INTERVAL},
+            },
+            # Safety net. Changes are reconciled right away through reconcile_node_now
             'check-node-compliance': {
                 'task': 'app.tasks.schedule.check_node_compliance',
-                'schedule': 10.0,
+                'schedule': CHECK_NODE_COMPLIANCE_INTERVAL,
+                'options': {'expires': CHECK_NODE_COMPLIANCE_INTERVAL},
+            },
+            'reap-idle-cubicles': {
+                'task': 'app.tasks.schedule.reap_idle_cubicles',
+                'schedule': REAP_IDLE_CUBICLES_INTERVAL,
+                'options': {'expires': REAP_IDLE_CUBICLES_INTERVAL},
             },
         },
     }
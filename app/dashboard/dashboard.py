@@ -12,6 +12,7 @@ from flask_login import login_required, current_user
 from app.extensions import db, logger
 
 from app.models.cubicle import Cubicle
+from app.tasks.schedule import request_reconcile
 
 dashboard = Blueprint('dashboard', __name__, template_folder='templates')
 
@@ -59,6 +60,9 @@ def main_post():
     cubicle.active = True
     db.session.commit()
 
+    # Start the cubicle right away instead of waiting for the next compliance check
+    request_reconcile(cubicle.node_id, [cubicle.name])
+
     current_user.set_active_cubicle(requested_cubicle_id)
 
     # # Find the next_url path. Either from url or headers.
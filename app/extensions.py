@@ -44,6 +44,8 @@ def celery_init_app(app: Flask) -> Celery:
         # 'app.tasks.schedule.check_responsetime_cubicles',
         # 'app.tasks.schedule.check_responsetime_nodes',
         'app.tasks.schedule.check_node_compliance',
+        'app.tasks.schedule.reconcile_node_now',
+        'app.tasks.schedule.reap_idle_cubicles',
     ])
 
     return celery_app
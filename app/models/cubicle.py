@@ -23,6 +23,7 @@ class Cubicle(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint(name),
+        db.Index("ix_cubicle_active_user_id", active, user_id),
     )
     def __repr__(self):
         # pylint: disable=C0301:line-too-long
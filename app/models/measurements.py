@@ -3,14 +3,10 @@
 
 """ Measurement model """
 
-import random
 from io import BytesIO
-from base64 import b64encode
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from app.extensions import db
-from app.models.cubicle import Cubicle
-from app.models.node import Node
 
 # Disable C0411:wrong-import-order due to the need of matplotlib.use('Agg')-fix
 # Will otherwise cause all other imports to be "wrong"
@@ -22,7 +18,7 @@ matplotlib.use('Agg')
 # pylint: disable=C0411:wrong-import-order,C0413:wrong-import-position
 import matplotlib.dates as md
 # pylint: disable=C0411:wrong-import-order,C0413:wrong-import-position
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 
 # pylint: disable=R0903:too-few-public-methods
 class Measurement(db.Model):
@@ -63,11 +59,12 @@ class ResponseTimeNode(Measurement):
     }
 
 # pylint: disable=C0301:line-too-long
-def create_timestamp_graph(x_axis: list, y_axis: list, x_axis_name: str, y_axis_name: str, title: str) -> str|None:
-    """ Create a graph with timestamp on x-axis """
-    graph = None
-
-    figure, axes = plt.subplots(figsize=(8,3), dpi=300)
+def render_timestamp_graph(x_axis: list, y_axis: list, x_axis_name: str, y_axis_name: str, title: str) -> bytes:
+    """ Render a graph with timestamp on x-axis as PNG """
+    # A Figure without pyplot is not tracked globally, so it is freed after use and
+    # can be rendered from several threads
+    figure = Figure(figsize=(8,3), dpi=300)
+    axes = figure.subplots()
 
     # Set titles and make them white
     axes.set_title(title, color="#ffffff")
@@ -86,33 +83,4 @@ def create_timestamp_graph(x_axis: list, y_axis: list, x_axis_name: str, y_axis_
 
     with BytesIO() as buffer:
         figure.savefig(buffer, format="png", transparent=True)
-        graph = b64encode(buffer.getbuffer()).decode("ascii")
-
-    return graph
-
-
-def setup(session):
-    """ Model setup """
-    for cubicle in Cubicle.query.all():
-        for i in range(1440):
-            response_time = ResponseTimeCubicle()
-            response_time.rtt = random.randint(1, 50)
-            response_time.method = "http"
-            response_time.timestamp = datetime.utcnow() - timedelta(minutes=i)
-
-            cubicle.measurements.append(response_time)
-            session.add(response_time)
-
-        session.commit()
-
-    for node in Node.query.all():
-        for i in range(1440):
-            response_time = ResponseTimeNode()
-            response_time.rtt = random.randint(1, 50)
-            response_time.method = "http"
-            response_time.timestamp = datetime.utcnow() - timedelta(minutes=i)
-
-            node.measurements.append(response_time)
-            session.add(response_time)
-
-        session.commit()
+        return buffer.getvalue()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Status reports pushed by the node agents (POST /api/report)
+
+A report holds the cubicles and networks running on a node and RTT samples. The latest
+report of every node is stored with set-based statements: one upsert per kind and one
+DELETE for what is no longer running. RTT samples are written in batches by the sample
+buffer. The scheduled tasks use a fresh report instead of asking the node.
+"""
+
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.config import NODE_REPORT_MAX_AGE
+from app.extensions import db
+
+from app.models.cubicle import Cubicle
+from app.models.node import Node
+
+from app.timeseries.ingest import sample_buffer
+
+class NodeReport(db.Model):
+    """ Base class for NodeReport-model. When a node last reported """
+    __tablename__ = 'node_report'
+
+    node_id = db.Column(db.Integer, primary_key=True)
+    reported_at = db.Column(db.DateTime, nullable=False)
+
+class ReportedCubicle(db.Model):
+    """ Base class for ReportedCubicle-model. A cubicle running on a node """
+    __tablename__ = 'reported_cubicle'
+
+    id = db.Column(db.Integer, primary_key=True)
+    node_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(128), nullable=False)
+    image = db.Column(db.String(128))
+
+    __table_args__ = (
+        db.UniqueConstraint(node_id, name),
+    )
+
+class ReportedNetwork(db.Model):
+    """ Base class for ReportedNetwork-model. A network present on a node """
+    __tablename__ = 'reported_network'
+
+    id = db.Column(db.Integer, primary_key=True)
+    node_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(150), nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint(node_id, name),
+    )
+
+def parse_report(data: dict) -> dict:
+    """
+    Validate a report, e.g.
+    {
+     "cubicles": [{"name": "machine-1", "image": "divisora/cubicle-ubuntu:latest"}],
+     "networks": [{"name": "net-1"}],
+     "rtt": [{"rtt": 1.5, "timestamp": 1700000000.0}, {"cubicle": "machine-1", "rtt": 3.2}]
+    }
+    Cubicles and networks may also be given as plain names. 'rtt' must be a finite number,
+    'cubicle' and 'image' strings. Raises ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Report must be a JSON object")
+
+    def names(key: str, extra: tuple = ()) -> dict[str, dict]:
+        items = data.get(key, [])
+        if not isinstance(items, list):
+            raise ValueError(f"'{key}' must be a list")
+        result = {}
+        for item in items:
+            item = {"name": item} if isinstance(item, str) else item
+            if not isinstance(item, dict) or not isinstance(item.get("name"), str) or not item["name"]:
+                raise ValueError(f"Every item in '{key}' needs a name")
+            for k in extra:
+                if not isinstance(item.get(k), (str, type(None))):
+                    raise ValueError(f"'{k}' of {item['name']} in '{key}' must be a string")
+            result[item["name"]] = {k: item.get(k) for k in extra}
+        return result
+
+    items = data.get("rtt", [])
+    if not isinstance(items, list):
+        raise ValueError("'rtt' must be a list")
+    samples = []
+    for sample in items:
+        if not isinstance(sample, dict):
+            raise ValueError(f"Bad RTT sample {sample}")
+        rtt = sample.get("rtt")
+        # bool is an int, but not a response time
+        if isinstance(rtt, bool) or not isinstance(rtt, (int, float)) or not math.isfinite(rtt):
+            raise ValueError(f"Bad RTT sample {sample}, 'rtt' must be a finite number")
+        if not isinstance(sample.get("cubicle"), (str, type(None))):
+            raise ValueError(f"Bad RTT sample {sample}, 'cubicle' must be a name")
+        try:
+            timestamp = sample.get("timestamp")
+            timestamp = datetime.utcfromtimestamp(float(timestamp)) if timestamp is not None else datetime.utcnow()
+        except (TypeError, ValueError, OverflowError, OSError) as _err:
+            raise ValueError(f"Bad RTT sample {sample}") from _err
+        samples.append((sample.get("cubicle"), float(rtt), timestamp))
+
+    return {
+        "cubicles": names("cubicles", ("image",)),
+        "networks": names("networks"),
+        "rtt": samples,
+    }
+
+def _upsert(model, rows: list[dict], keys: list[str], columns: list[str]):
+    """ INSERT ... ON CONFLICT (keys) DO UPDATE columns, where the database supports it """
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        stmt = (postgresql if dialect == "postgresql" else sqlite).insert(model)
+        if columns:
+            stmt = stmt.on_conflict_do_update(index_elements=keys,
+                                              set_={c: getattr(stmt.excluded, c) for c in columns})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        db.session.execute(stmt, rows)
+        return
+
+    # Other databases: replace the rows
+    for row in rows:
+        db.session.execute(delete(model).where(*[getattr(model, k) == row[k] for k in keys]))
+    db.session.execute(insert(model), rows)
+
+def _replace_set(model, node_id: int, items: dict[str, dict], columns: list[str]):
+    """ Make the rows of 'model' for the node equal to 'items' ({name: {column: value}}) """
+    _upsert(model, [{"node_id": node_id, "name": name, **values} for name, values in items.items()],
+            ["node_id", "name"], columns)
+    stmt = delete(model).where(model.node_id == node_id)
+    if items:
+        stmt = stmt.where(model.name.not_in(list(items)))
+    db.session.execute(stmt)
+
+def ingest_report(node_id: int, report: dict) -> dict:
+    """ Store a report parsed by parse_report() as the latest state of the node """
+    now = datetime.utcnow()
+    _upsert(NodeReport, [{"node_id": node_id, "reported_at": now}], ["node_id"], ["reported_at"])
+    _replace_set(ReportedCubicle, node_id, report["cubicles"], ["image"])
+    _replace_set(ReportedNetwork, node_id, report["networks"], [])
+
+    samples = report["rtt"]
+    cubicle_ids = {}
+    names = {cubicle for cubicle, _, _ in samples if cubicle}
+    if names:
+        stmt = select(Cubicle.name, Cubicle.id).where(Cubicle.node_id == node_id, Cubicle.name.in_(names))
+        cubicle_ids = dict(db.session.execute(stmt).all())
+
+    node_samples = [("node", node_id, rtt, timestamp) for cubicle, rtt, timestamp in samples if not cubicle]
+    cubicle_samples = [("cubicle", cubicle_ids[cubicle], rtt, timestamp)
+                       for cubicle, rtt, timestamp in samples if cubicle in cubicle_ids]
+    if node_samples:
+        latest = max(node_samples, key=lambda sample: sample[3])
+        db.session.execute(update(Node).where(Node.id == node_id).values(response_time=latest[2]))
+
+    db.session.commit()
+
+    # Written in batches by the sample buffer
+    sample_buffer.add_many(node_samples + cubicle_samples)
+    return {
+        "cubicles": len(report["cubicles"]),
+        "networks": len(report["networks"]),
+        "samples": len(node_samples) + len(cubicle_samples),
+    }
+
+def reporting_nodes(node_ids: list[int]|None = None, max_age: float = NODE_REPORT_MAX_AGE) -> set[int]:
+    """ Nodes that reported within 'max_age' seconds """
+    stmt = select(NodeReport.node_id).where(NodeReport.reported_at >= datetime.utcnow() - timedelta(seconds=max_age))
+    if node_ids is not None:
+        stmt = stmt.where(NodeReport.node_id.in_(node_ids))
+    return set(db.session.execute(stmt).scalars())
+
+def fresh_reports(node_ids: list[int]|None = None,
+                  max_age: float = NODE_REPORT_MAX_AGE) -> dict[int, tuple[dict[str, dict], set[str], datetime]]:
+    """
+    Latest state of nodes that reported within 'max_age' seconds. One query, plus two if
+    any node reported. Returns
+    {node_id: ({cubicle name: {"name", "image"}}, {network names}, when it was reported)}
+    """
+    stmt = (
+        select(NodeReport.node_id, NodeReport.reported_at)
+        .where(NodeReport.reported_at >= datetime.utcnow() - timedelta(seconds=max_age))
+    )
+    if node_ids is not None:
+        stmt = stmt.where(NodeReport.node_id.in_(node_ids))
+    reports = {node_id: ({}, set(), reported_at) for node_id, reported_at in db.session.execute(stmt)}
+    if not reports:
+        return reports
+
+    stmt = select(ReportedCubicle.node_id, ReportedCubicle.name, ReportedCubicle.image)
+    for node_id, name, image in db.session.execute(stmt.where(ReportedCubicle.node_id.in_(reports))):
+        reports[node_id][0][name] = {"name": name, "image": image}
+
+    stmt = select(ReportedNetwork.node_id, ReportedNetwork.name)
+    for node_id, name in db.session.execute(stmt.where(ReportedNetwork.node_id.in_(reports))):
+        reports[node_id][1].add(name)
+    return reports
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Revision of the desired state of the nodes
+
+Every change to what a node should run (a cubicle activated, deactivated, moved, renamed
+or deleted, or a change to the owner, image, node or network shown in the cubicle feed)
+adds a DesiredStateChange row. Its id is the revision, so revisions only grow. A node
+agent that knows revision N only has to look at the rows after N for its node.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import event, func, inspect, insert, select, delete
+
+from app.extensions import db
+
+from app.models.cubicle import Cubicle
+from app.models.image import Image
+from app.models.network import Network
+from app.models.node import Node
+from app.models.user import User
+
+CHANGE_ADDED = "added"
+CHANGE_CHANGED = "changed"
+CHANGE_REMOVED = "removed"
+
+class DesiredStateChange(db.Model):
+    """ Base class for DesiredStateChange-model """
+    __tablename__ = 'desired_state_change'
+
+    id = db.Column(db.Integer, primary_key=True)
+    node_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(128), nullable=False)
+    kind = db.Column(db.String(8), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_desired_state_change_node_id_id", node_id, id),
+    )
+
+    def __repr__(self):
+        return f'<Revision "{self.id}", Node "{self.node_id}", Name "{self.name}", Kind "{self.kind}">'
+
+def record_changes(connection, changes: list[tuple[int, str, str]]):
+    """ Add (node_id, name, kind) changes. Use the connection of the current flush/transaction """
+    rows = [
+        {"node_id": node_id, "name": name, "kind": kind, "timestamp": datetime.utcnow()}
+        for node_id, name, kind in changes if node_id is not None and name
+    ]
+    if rows:
+        connection.execute(insert(DesiredStateChange.__table__), rows)
+
+def current_revision() -> int:
+    """
+    Latest revision of all nodes. It is the same for every node, so a quiet node whose own
+    changes were pruned still gets a revision that prune_changes() keeps
+    """
+    return db.session.execute(select(func.max(DesiredStateChange.id))).scalar() or 0
+
+def oldest_revision() -> int:
+    """ Oldest revision still kept. Changes before it have been pruned """
+    return db.session.execute(select(func.min(DesiredStateChange.id))).scalar() or 0
+
+def changes_since(revision: int, node_id: int|None = None) -> dict[tuple[int, str], set[str]]:
+    """ Kinds of change per (node_id, name) after 'revision' """
+    stmt = (
+        select(DesiredStateChange.node_id, DesiredStateChange.name, DesiredStateChange.kind)
+        .where(DesiredStateChange.id > revision)
+    )
+    if node_id is not None:
+        stmt = stmt.where(DesiredStateChange.node_id == node_id)
+
+    changes = {}
+    for _node_id, name, kind in db.session.execute(stmt):
+        changes.setdefault((_node_id, name), set()).add(kind)
+    return changes
+
+def prune_changes(before: datetime) -> int:
+    """ Remove changes older than 'before'. The latest change is always kept """
+    latest = select(func.max(DesiredStateChange.id)).scalar_subquery()
+    result = db.session.execute(
+        delete(DesiredStateChange)
+        .where(DesiredStateChange.timestamp < before, DesiredStateChange.id < latest)
+    )
+    return result.rowcount
+
+def _history(target, key: str):
+    """ (old value, new value) of an attribute in the current flush """
+    history = inspect(target).attrs[key].history
+    new = getattr(target, key)
+    old = history.deleted[0] if history.deleted else new
+    return old, new
+
+def _changed(target, *keys) -> bool:
+    return any(inspect(target).attrs[key].history.has_changes() for key in keys)
+
+def _active_cubicles(connection, *criteria) -> list[tuple[int, str, str]]:
+    rows = connection.execute(
+        # pylint: disable-next=C0121:singleton-comparison
+        select(Cubicle.node_id, Cubicle.name).where(Cubicle.active == True, Cubicle.user_id != None, *criteria)
+    )
+    return [(node_id, name, CHANGE_CHANGED) for node_id, name in rows]
+
+def _load_previous_value(*_):
+    """ No-op. Registered with active_history, so the old value is in the history on flush """
+
+# Moves, renames and (de)activations must know the previous value, also when the
+# attribute was expired (e.g. after a commit) before it was set
+for _attribute in (Cubicle.active, Cubicle.user_id, Cubicle.node_id, Cubicle.name,
+                   Network.user_id, Network.node_id):
+    event.listen(_attribute, "set", _load_previous_value, active_history=True)
+
+@event.listens_for(Cubicle, "after_insert")
+def _cubicle_inserted(_, connection, target):
+    if target.active and target.user_id is not None:
+        record_changes(connection, [(target.node_id, target.name, CHANGE_ADDED)])
+
+@event.listens_for(Cubicle, "after_update")
+def _cubicle_updated(_, connection, target):
+    old_active, new_active = _history(target, "active")
+    old_user, new_user = _history(target, "user_id")
+    old_node, new_node = _history(target, "node_id")
+    old_name, new_name = _history(target, "name")
+    was_desired = old_active and old_user is not None
+    is_desired = new_active and new_user is not None
+
+    changes = []
+    if (old_node, old_name) != (new_node, new_name) or was_desired != is_desired:
+        if was_desired:
+            changes.append((old_node, old_name, CHANGE_REMOVED))
+        if is_desired:
+            changes.append((new_node, new_name, CHANGE_ADDED))
+    elif is_desired and _changed(target, "user_id", "image_id", "novnc_port"):
+        changes.append((new_node, new_name, CHANGE_CHANGED))
+    record_changes(connection, changes)
+
+@event.listens_for(Cubicle, "after_delete")
+def _cubicle_deleted(_, connection, target):
+    if target.active and target.user_id is not None:
+        record_changes(connection, [(target.node_id, target.name, CHANGE_REMOVED)])
+
+def _network_changes(connection, target) -> list[tuple[int, str, str]]:
+    # The network shown for a cubicle is the first one of its owner on the node
+    old_user, new_user = _history(target, "user_id")
+    old_node, new_node = _history(target, "node_id")
+    changes = []
+    for user_id, node_id in {(old_user, old_node), (new_user, new_node)}:
+        if user_id is None or node_id is None:
+            continue
+        changes += _active_cubicles(connection, Cubicle.user_id == user_id, Cubicle.node_id == node_id)
+    return changes
+
+@event.listens_for(Network, "after_insert")
+@event.listens_for(Network, "after_delete")
+def _network_added_or_deleted(_, connection, target):
+    record_changes(connection, _network_changes(connection, target))
+
+@event.listens_for(Network, "after_update")
+def _network_updated(_, connection, target):
+    if _changed(target, "name", "user_id", "node_id"):
+        record_changes(connection, _network_changes(connection, target))
+
+@event.listens_for(Image, "after_update")
+def _image_updated(_, connection, target):
+    if _changed(target, "image"):
+        record_changes(connection, _active_cubicles(connection, Cubicle.image_id == target.id))
+
+@event.listens_for(User, "after_update")
+def _user_updated(_, connection, target):
+    if _changed(target, "username"):
+        record_changes(connection, _active_cubicles(connection, Cubicle.user_id == target.id))
+
+@event.listens_for(Node, "after_update")
+def _node_updated(_, connection, target):
+    if _changed(target, "name"):
+        record_changes(connection, _active_cubicles(connection, Cubicle.node_id == target.id))
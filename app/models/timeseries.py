@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compact storage of response time samples
+
+One narrow row per sample: (kind, entity_id, timestamp, rtt). The primary key is
+(kind, entity_id, timestamp), so reading the samples of a cubicle or node in a time
+range is a range scan of the key. Replaces ResponseTimeCubicle / ResponseTimeNode,
+which stored two rows per sample and needed a JOIN to read them.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, exists, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.config import RTT_INGEST_BATCH
+from app.extensions import db, logger
+
+from app.models.cubicle import Cubicle
+from app.models.node import Node
+from app.models.measurements import Measurement, ResponseTimeCubicle, ResponseTimeNode
+
+KIND_CUBICLE = 1
+KIND_NODE = 2
+
+KINDS = {
+    "cubicle": KIND_CUBICLE,
+    "node": KIND_NODE,
+}
+
+class RttSample(db.Model):
+    """ Base class for RttSample-model. A response time sample of a cubicle or node """
+    __tablename__ = 'rtt_sample'
+
+    kind = db.Column(db.SmallInteger, primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
+    rtt = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return f'<RttSample "{self.kind}:{self.entity_id}", Timestamp "{self.timestamp}", RTT "{self.rtt}">'
+
+def _on_conflict_dialect():
+    """ Dialect module with INSERT ... ON CONFLICT DO NOTHING for the database, or None """
+    return {"postgresql": postgresql, "sqlite": sqlite}.get(db.session.get_bind().dialect.name)
+
+def _insert_ignoring_duplicates():
+    """ INSERT that skips samples already stored, where the database supports it """
+    dialect = _on_conflict_dialect()
+    if dialect is None:
+        return insert(RttSample)
+    return dialect.insert(RttSample).on_conflict_do_nothing()
+
+def insert_samples(samples: list[dict], batch_size: int = RTT_INGEST_BATCH) -> int:
+    """
+    Insert samples ({"kind", "entity_id", "timestamp", "rtt"}) with one executemany per
+    'batch_size' samples. Does not commit
+    """
+    stmt = _insert_ignoring_duplicates()
+    for first in range(0, len(samples), batch_size):
+        db.session.execute(stmt, samples[first:first + batch_size])
+    return len(samples)
+
+def migrate_legacy_samples(batch_size: int = RTT_INGEST_BATCH, remove: bool = False) -> dict[str, int]:
+    """
+    Copy the samples of ResponseTimeCubicle / ResponseTimeNode to RttSample, 'batch_size'
+    measurements per INSERT ... SELECT, committing after every batch. Safe to run again,
+    samples already copied are skipped (by ON CONFLICT DO NOTHING where the database has
+    it, else by NOT EXISTS). With 'remove' the copied rows are deleted. Rows without
+    cubicle/node or timestamp can not be copied. They are kept, also with 'remove'
+    """
+    RttSample.__table__.create(db.engine, checkfirst=True)
+
+    copied = {}
+    for kind, model, entity_id in (("cubicle", ResponseTimeCubicle, ResponseTimeCubicle.cubicle_id),
+                                   ("node", ResponseTimeNode, ResponseTimeNode.node_id)):
+        copied[kind] = 0
+        migratable = (entity_id.is_not(None), model.timestamp.is_not(None))
+        first, last = db.session.execute(select(func.min(model.id), func.max(model.id))).one()
+        if first is None:
+            continue
+
+        for start in range(first, last + 1, batch_size):
+            end = start + batch_size
+            rows = (
+                select(db.literal(KINDS[kind]), entity_id, model.timestamp, func.coalesce(model.rtt, 0.0))
+                .where(model.id >= start, model.id < end, *migratable)
+            )
+            if _on_conflict_dialect() is None:
+                rows = rows.where(~exists().where(RttSample.kind == KINDS[kind], RttSample.entity_id == entity_id,
+                                                  RttSample.timestamp == model.timestamp))
+            stmt = _insert_ignoring_duplicates().from_select(["kind", "entity_id", "timestamp", "rtt"], rows)
+            copied[kind] += db.session.execute(stmt).rowcount
+            if remove:
+                stmt = select(model.id).where(model.id >= start, model.id < end, *migratable)
+                ids = db.session.execute(stmt).scalars().all()
+                if ids:
+                    db.session.execute(delete(model.__table__).where(model.__table__.c.id.in_(ids)))
+                    db.session.execute(delete(Measurement.__table__).where(Measurement.__table__.c.id.in_(ids)))
+            db.session.commit()
+        logger.info(f"Copied {copied[kind]} {kind} response time samples")
+        if remove:
+            kept = db.session.execute(select(func.count(model.id)).where(~and_(*migratable))).scalar()
+            if kept:
+                logger.warning(f"Kept {kept} {kind} response time rows without {kind} or timestamp")
+    return copied
+
+def setup(session):
+    """ Model setup """
+    now = datetime.utcnow()
+    samples = []
+    for kind, model in ((KIND_CUBICLE, Cubicle), (KIND_NODE, Node)):
+        for entity_id in session.execute(select(model.id)).scalars():
+            samples += [
+                {"kind": kind, "entity_id": entity_id, "timestamp": now - timedelta(minutes=i),
+                 "rtt": float(random.randint(1, 50))}
+                for i in range(1440)
+            ]
+    insert_samples(samples)
+    session.commit()
@@ -4,19 +4,18 @@
 """ User model """
 
 from datetime import datetime
-from urllib.parse import urlparse, urlunparse
 
 from flask import session
 from flask_login import UserMixin, current_user
 
 from sqlalchemy_utils import PasswordType
 from sqlalchemy_utils import force_auto_coercion
-from sqlalchemy import and_
 from sqlalchemy import event
 
 import pyotp
 
 from app.extensions import db
+from app.cache.upstream import get_upstream_novnc, evict_user, has_relevant_changes
 from app.models.cubicle import Cubicle
 from app.models.events import EventLog
 from app.models.node import Node
@@ -39,7 +38,7 @@ class User(UserMixin, db.Model):
     totp_enforce = db.Column(db.Boolean, default=True, nullable=False)
     totp_key = db.Column(db.String(32))
     admin = db.Column(db.Boolean, default=False, nullable=False)
-    last_activity = db.Column(db.DateTime(timezone=True))
+    last_activity = db.Column(db.DateTime(timezone=True), index=True)
     cubicles = db.relationship("Cubicle", backref="user", lazy="joined")
     networks = db.relationship("Network", backref="user", lazy="joined")
     events = db.relationship("EventLog", backref="user", lazy="joined")
@@ -141,37 +140,7 @@ class User(UserMixin, db.Model):
 
     def get_upstream_novnc(self) -> str:
         """ Get the upstream adress to the NoVNC """
-
-        # # pylint: disable=C0121:singleton-comparison
-        # cubicle = Cubicle.query.filter(
-        #     and_(
-        #         Cubicle.user_id == self.id,
-        #         Cubicle.active == True,
-        #     )).order_by(Cubicle.id).first()
-
-        # if not cubicle or not cubicle.node:
-        #     return ""
-
-        upstream_url = urlparse('')
-
-        for cubicle in self.cubicles:
-            if cubicle.id != session["cubicle_id"]:
-                continue
-
-            scheme = "http" if cubicle.insecure else "https"
-
-            if cubicle.novnc_name != "":
-                netloc = cubicle.novnc_name
-            else:
-                netloc = cubicle.node.domain_name if cubicle.node.domain_name != "" else str(cubicle.node.ip_address)
-            netloc += f":{cubicle.novnc_port}"
-            
-            upstream_url = upstream_url._replace(scheme=scheme, netloc=netloc)
-
-            # Always break if cubicle is found
-            break
-
-        return urlunparse(upstream_url)
+        return get_upstream_novnc(self.id, session.get("cubicle_id"))
 
     def assign_network(self):
         """ Assign a network to user """
@@ -241,6 +210,17 @@ def delete_user_log(_, connection, target):
         )
     )
 
+@event.listens_for(User, "after_update")
+def evict_upstream_cache(_, __, target):
+    """ Drop cached NoVNC upstreams when the user is changed """
+    if has_relevant_changes(target, {"last_activity"}):
+        evict_user(target.id)
+
+@event.listens_for(User, "after_delete")
+def evict_upstream_cache_deleted(_, __, target):
+    """ Drop cached NoVNC upstreams when the user is removed """
+    evict_user(target.id)
+
 def setup(session):
     """ Model setup """
     users = [
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+In-memory stand-in for the node agent
+
+Serves the parts of the node agent API used by the scheduled tasks ('/', '/api/v1/login',
+'/api/v1/cubicle' and '/api/v1/network') from memory, with configurable latency, error
+rate and hanging requests. Many agents can run on localhost ports at the same time, e.g.
+to benchmark reconciliation of a large fleet without real nodes.
+
+- python -m app.simulator.node_agent --count 200 --latency 0.01 --error-rate 0.05
+"""
+
+import argparse
+import json
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Request handler. The agent is reached through self.server.agent """
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable-next=C0103:invalid-name
+    def do_GET(self):
+        """ Handle GET """
+        self.server.agent.handle(self, "GET")
+
+    # pylint: disable-next=C0103:invalid-name
+    def do_PUT(self):
+        """ Handle PUT """
+        self.server.agent.handle(self, "PUT")
+
+    # pylint: disable-next=C0103:invalid-name
+    def do_DELETE(self):
+        """ Handle DELETE """
+        self.server.agent.handle(self, "DELETE")
+
+    def send_json(self, status: int, data: dict, headers: dict|None = None):
+        """ Send a JSON response, keeping the connection open """
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self) -> dict:
+        """ Body of the request as JSON """
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    # pylint: disable-next=W0622:redefined-builtin
+    def log_message(self, format, *args):
+        pass
+
+# pylint: disable-next=R0902:too-many-instance-attributes
+class SimulatedNodeAgent():
+    """
+    One simulated node agent.
+
+    'latency' (+- 'jitter') seconds are added to every request. A share 'error_rate' of
+    the requests is answered with 503, and a share 'timeout_rate' hangs for 'timeout'
+    seconds before it is answered.
+    """
+
+    # pylint: disable-next=R0913:too-many-arguments
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, timeout_rate: float = 0.0, timeout: float = 30.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.cubicles = {}
+        self.networks = {}
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.agent = self
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        """ Address the agent listens on """
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        """ Port the agent listens on """
+        return self._server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        """ Base URL of the agent """
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def request_count(self) -> int:
+        """ Number of requests served """
+        with self._lock:
+            return sum(self.requests.values())
+
+    def handle(self, handler: _Handler, method: str):
+        """ Dispatch a request, with simulated latency and failures """
+        path = handler.path.split("?", 1)[0]
+        route = path if not path.startswith("/api/v1/cubicle/") else "/api/v1/cubicle/<name>"
+        with self._lock:
+            self.requests[f"{method} {route}"] += 1
+
+        # Read the body before deciding anything, so the connection stays usable
+        data = handler.read_json() if method == "PUT" else {}
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.timeout_rate and random.random() < self.timeout_rate:
+            time.sleep(self.timeout)
+        if self.error_rate and random.random() < self.error_rate:
+            handler.send_json(503, {"error": "Simulated error"})
+            return
+
+        if method == "GET" and path == "/":
+            handler.send_json(200, {})
+        elif method == "GET" and path == "/api/v1/login":
+            handler.send_json(200, {}, {"Set-Cookie": f"session={secrets.token_hex(16)}; HttpOnly; Path=/"})
+        elif path == "/api/v1/cubicle":
+            self._collection(handler, method, self.cubicles, data)
+        elif path == "/api/v1/network":
+            self._collection(handler, method, self.networks, data)
+        elif method == "DELETE" and path.startswith("/api/v1/cubicle/"):
+            with self._lock:
+                cubicle = self.cubicles.pop(unquote(path.rsplit("/", 1)[1]), None)
+            handler.send_json(200 if cubicle is not None else 404, {})
+        else:
+            handler.send_json(404, {"error": "Not found"})
+
+    def _collection(self, handler: _Handler, method: str, items: dict, data: dict):
+        if method == "GET":
+            with self._lock:
+                results = list(items.values())
+            handler.send_json(200, {"results": results})
+            return
+        if method != "PUT" or not data.get("name"):
+            handler.send_json(400, {"error": "Bad request"})
+            return
+        # Like the real agent, a cubicle needs its network to exist
+        if items is self.cubicles and data.get("network") not in self.networks:
+            handler.send_json(400, {"error": f"Network {data.get('network')} does not exist"})
+            return
+        with self._lock:
+            items[data["name"]] = data
+        handler.send_json(200, {"name": data["name"]})
+
+    def __repr__(self):
+        return f'<SimulatedNodeAgent "{self.url}">'
+
+def start_fleet(count: int, host: str = "127.0.0.1", **kwargs) -> list[SimulatedNodeAgent]:
+    """ Start 'count' agents on free ports. Keyword arguments are passed to every agent """
+    return [SimulatedNodeAgent(host, 0, **kwargs).start() for _ in range(count)]
+
+def stop_fleet(agents: list[SimulatedNodeAgent]):
+    """ Stop all agents """
+    for agent in agents:
+        agent.stop()
+
+def main():
+    """ Run agents until interrupted """
+    parser = argparse.ArgumentParser(description="Simulated node agents")
+    parser.add_argument("--count", type=int, default=1, help="Number of agents")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="Port of the first agent. 0 for any free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +- seconds on the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of requests that hang")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds a hanging request hangs")
+    args = parser.parse_args()
+
+    agents = []
+    for i in range(args.count):
+        port = args.port + i if args.port else 0
+        agents.append(SimulatedNodeAgent(args.host, port, args.latency, args.jitter,
+                                         args.error_rate, args.timeout_rate, args.timeout).start())
+        print(agents[-1].url)
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_fleet(agents)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-node backoff and circuit breaker
+
+A node that fails a check is checked again after an exponentially growing delay
+(with jitter) instead of every cycle. After NODE_BREAKER_THRESHOLD failures in a row the
+circuit opens and the node is left alone for NODE_BREAKER_OPEN_TIME seconds, after which
+one trial check is allowed (half-open). A successful check closes the circuit again.
+
+The state is kept in one Redis hash on the Celery broker so all workers share it.
+Healthy nodes have no entry, so they cost nothing and are checked every cycle.
+"""
+
+import json
+import random
+import time
+from typing import NamedTuple
+
+import redis
+
+from app.config import NODE_BACKOFF_BASE, NODE_BACKOFF_MAX
+from app.config import NODE_BREAKER_THRESHOLD, NODE_BREAKER_OPEN_TIME
+from app.extensions import logger
+from app.tasks.locks import KEY_PREFIX, get_redis
+
+HEALTH_KEY = f"{KEY_PREFIX}:nodes:health"
+
+STATE_CLOSED = "closed"
+STATE_BACKOFF = "backoff"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+class NodeHealth(NamedTuple):
+    """ Polling state of a node. 'next_check' is a unix timestamp """
+    failures: int = 0
+    next_check: float = 0.0
+    opened: bool = False
+
+    def is_due(self, now: float|None = None) -> bool:
+        """ True if the node should be checked now """
+        return (now or time.time()) >= self.next_check
+
+    def state(self, now: float|None = None) -> str:
+        """ One of STATE_CLOSED, STATE_BACKOFF, STATE_OPEN or STATE_HALF_OPEN """
+        if self.opened:
+            return STATE_HALF_OPEN if self.is_due(now) else STATE_OPEN
+        if self.failures:
+            return STATE_BACKOFF
+        return STATE_CLOSED
+
+HEALTHY = NodeHealth()
+
+def next_health(health: NodeHealth, ok: bool, now: float|None = None) -> NodeHealth:
+    """ State of a node after a check that succeeded ('ok') or failed """
+    if ok:
+        return HEALTHY
+
+    now = now or time.time()
+    failures = health.failures + 1
+    if failures >= NODE_BREAKER_THRESHOLD:
+        return NodeHealth(failures, now + NODE_BREAKER_OPEN_TIME, True)
+
+    delay = min(NODE_BACKOFF_MAX, NODE_BACKOFF_BASE * (2 ** (failures - 1)))
+    return NodeHealth(failures, now + delay * random.uniform(0.5, 1.5), False)
+
+def load_health(client: redis.Redis|None = None) -> dict[int, NodeHealth]:
+    """ State of all nodes that are not healthy. Missing nodes are healthy """
+    try:
+        entries = (client or get_redis()).hgetall(HEALTH_KEY)
+    except redis.RedisError as _err:
+        logger.warning(f"Could not load node health ({_err}). Checking all nodes")
+        return {}
+
+    health = {}
+    for node_id, value in entries.items():
+        try:
+            health[int(node_id)] = NodeHealth(*json.loads(value))
+        except (ValueError, TypeError):
+            continue
+    return health
+
+def record_results(results: dict[int, bool],
+                   health: dict[int, NodeHealth],
+                   client: redis.Redis|None = None) -> dict[int, NodeHealth]:
+    """
+    Update the state of the nodes in 'results' ({node_id: ok}), given their current
+    'health' as returned by load_health(). Only changed nodes are written.
+    Returns the new state of the nodes that are not healthy.
+    """
+    now = time.time()
+    changed = {}
+    recovered = []
+    for node_id, ok in results.items():
+        current = health.get(node_id, HEALTHY)
+        new = next_health(current, ok, now)
+        if new == current:
+            continue
+        if new == HEALTHY:
+            recovered.append(node_id)
+            logger.info(f"Node {node_id} is healthy again")
+        else:
+            changed[node_id] = new
+            if new.opened and not current.opened:
+                logger.warning(f"Node {node_id} failed {new.failures} times in a row. Circuit opened")
+
+    try:
+        pipe = (client or get_redis()).pipeline()
+        if changed:
+            pipe.hset(HEALTH_KEY, mapping={k: json.dumps(list(v)) for k, v in changed.items()})
+        if recovered:
+            pipe.hdel(HEALTH_KEY, *recovered)
+        pipe.execute()
+    except redis.RedisError as _err:
+        logger.warning(f"Could not save node health: {_err}")
+
+    new_health = {k: v for k, v in health.items() if k not in recovered}
+    new_health.update(changed)
+    return new_health
+
+def forget_nodes(node_ids: list[int], client: redis.Redis|None = None):
+    """ Remove the state of nodes, e.g. deleted ones """
+    if not node_ids:
+        return
+    try:
+        (client or get_redis()).hdel(HEALTH_KEY, *node_ids)
+    except redis.RedisError as _err:
+        logger.warning(f"Could not remove node health: {_err}")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Desired state of all nodes, used by the reconciliation
+
+The state is loaded at the start of a cycle with a fixed number of queries, no matter
+how many nodes or cubicles there are. The reconciliation of a node only reads from it.
+"""
+
+from datetime import datetime
+from typing import NamedTuple
+
+from sqlalchemy import and_, select
+
+from app.extensions import db
+
+from app.models.cubicle import Cubicle
+from app.models.image import Image
+from app.models.network import Network
+from app.models.report import fresh_reports
+from app.models.node import Node
+from app.models.user import User
+
+class DesiredNetwork(NamedTuple):
+    """ Network that must exist on a node """
+    name: str
+    ip_range: object
+
+class DesiredImage(NamedTuple):
+    """ Resource limits of an image """
+    image: str
+    cpu_limit: int|None
+    mem_limit: str|None
+
+class DesiredCubicle(NamedTuple):
+    """ Cubicle that must run on a node """
+    id: int
+    name: str
+    owner: str
+    image: str
+    cpu_limit: int|None
+    mem_limit: str|None
+    novnc_port: int
+    network: DesiredNetwork|None
+
+class DesiredNode(NamedTuple):
+    """
+    Node with everything it must run, indexed by name. 'images' has the limits of all
+    images and 'inactive' the image of each inactive cubicle on the node. If the node
+    recently pushed a status report, 'reported_*' hold what it runs and when it was
+    reported, else they are None
+    """
+    id: int
+    name: str
+    domain_name: str
+    ip_address: object
+    port: int
+    cubicles: dict[str, DesiredCubicle]
+    networks: dict[str, DesiredNetwork]
+    images: dict[str, DesiredImage]
+    inactive: dict[str, str|None]
+    reported_cubicles: dict[str, dict]|None = None
+    reported_networks: set[str]|None = None
+    reported_at: datetime|None = None
+
+def build_desired_state(node_ids: list[int]|None = None) -> dict[int, DesiredNode]:
+    """
+    Load the desired state for all nodes (or only 'node_ids'). Returns {node_id: DesiredNode}.
+    Uses four queries: one for the nodes, the images, the cubicles and the status reports
+    (two more if any node has reported recently).
+    """
+    stmt = select(Node.id, Node.name, Node.domain_name, Node.ip_address, Node.port)
+    if node_ids is not None:
+        stmt = stmt.where(Node.id.in_(node_ids))
+    nodes = db.session.execute(stmt).all()
+    if not nodes:
+        return {}
+
+    # All images, to know what removing a cubicle of an image frees. Shared by all nodes
+    images = {}
+    for image, cpu_limit, mem_limit in db.session.execute(select(Image.image, Image.cpu_limit, Image.mem_limit)):
+        images[image] = DesiredImage(image, cpu_limit, mem_limit)
+
+    reports = fresh_reports([node.id for node in nodes] if node_ids is not None else None)
+
+    state = {}
+    for _id, name, domain_name, ip_address, port in nodes:
+        reported_cubicles, reported_networks, reported_at = reports.get(_id, (None, None, None))
+        state[_id] = DesiredNode(_id, name, domain_name, ip_address, port, {}, {}, images, {},
+                                 reported_cubicles, reported_networks, reported_at)
+
+    # Cubicles with owner, image and the owners network on the same node.
+    stmt = (
+        select(Cubicle.id,
+               Cubicle.name,
+               Cubicle.node_id,
+               Cubicle.active,
+               Cubicle.novnc_port,
+               User.name,
+               Image.image,
+               Image.cpu_limit,
+               Image.mem_limit,
+               Network.name,
+               Network.ip_range)
+        .join(User, Cubicle.user_id == User.id)
+        .outerjoin(Image, Cubicle.image_id == Image.id)
+        .outerjoin(Network, and_(Network.node_id == Cubicle.node_id,
+                                 Network.user_id == Cubicle.user_id))
+        .where(Cubicle.node_id.in_(state.keys()))
+        .order_by(Cubicle.id, Network.id)
+    )
+    for row in db.session.execute(stmt).all():
+        # pylint: disable-next=C0301:line-too-long
+        _id, name, node_id, active, novnc_port, owner, image, cpu_limit, mem_limit, network_name, network_range = row
+        node = state[node_id]
+        if not active:
+            node.inactive[name] = image
+            continue
+        # A user with several networks on the node gives several rows. Use the first one
+        if name in node.cubicles:
+            continue
+
+        network = None
+        if network_name is not None:
+            network = node.networks.get(network_name)
+            if network is None:
+                network = DesiredNetwork(network_name, network_range)
+                node.networks[network_name] = network
+
+        node.cubicles[name] = DesiredCubicle(_id, name, owner, image, cpu_limit, mem_limit, novnc_port, network)
+
+    return state
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Single-flight locks and cycle metrics for scheduled tasks
+
+Locks and counters are kept in the Redis instance already used as Celery broker, so
+they are shared by all workers. If Redis can not be reached the locks fail open,
+i.e. the task runs as it would have without them.
+"""
+
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+from flask import current_app
+
+from app.extensions import logger
+
+KEY_PREFIX = "divisora"
+METRICS_KEY = f"{KEY_PREFIX}:metrics:tasks"
+
+# Only delete the lock if it is still ours
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_clients = {}
+
+def get_redis() -> redis.Redis:
+    """ Redis client for the Celery broker of the current app """
+    url = current_app.config["CELERY"]["broker_url"]
+    client = _clients.get(url)
+    if client is None:
+        client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        _clients[url] = client
+    return client
+
+@contextmanager
+def single_flight(name: str, ttl: float, client: redis.Redis|None = None):
+    """
+    Hold the lock 'name' while the block runs. Yields True if the lock was acquired and
+    False if someone else holds it. 'ttl' (seconds) must be longer than the block may run.
+    Pass 'client' when used outside of an app context, e.g. in a worker thread.
+    """
+    key = f"{KEY_PREFIX}:lock:{name}"
+    token = uuid.uuid4().hex
+    try:
+        client = client or get_redis()
+        acquired = bool(client.set(key, token, nx=True, px=int(ttl * 1000)))
+    except redis.RedisError as _err:
+        logger.warning(f"Lock {name} not available ({_err}). Running without it")
+        client = None
+        acquired = True
+
+    try:
+        yield acquired
+    finally:
+        if acquired and client is not None:
+            try:
+                client.eval(_RELEASE_SCRIPT, 1, key, token)
+            except redis.RedisError as _err:
+                logger.warning(f"Could not release lock {name}: {_err}")
+
+def _incr(field: str, amount: int = 1):
+    try:
+        get_redis().hincrby(METRICS_KEY, field, amount)
+    except redis.RedisError:
+        pass
+
+def record_skip(task: str):
+    """ Count a run that was skipped because the previous one was still running """
+    logger.warning(f"Skipping {task}, previous run is still in progress")
+    _incr(f"{task}:skipped")
+
+def record_cycle(task: str, duration: float, interval: float):
+    """ Count a finished run, and if it took longer than 'interval' count it as overrun """
+    _incr(f"{task}:runs")
+    if duration > interval:
+        logger.warning(f"{task} took {duration:.2f}s, longer than its interval ({interval}s)")
+        _incr(f"{task}:overrun")
+    try:
+        get_redis().hset(METRICS_KEY, f"{task}:last_duration", f"{duration:.3f}")
+    except redis.RedisError:
+        pass
+
+def get_task_metrics() -> dict[str, str]:
+    """ All task counters, e.g. {'check_all_nodes:skipped': '3', ...} """
+    try:
+        metrics = get_redis().hgetall(METRICS_KEY)
+    except redis.RedisError:
+        return {}
+    return {k.decode("utf-8"): v.decode("utf-8") for k, v in metrics.items()}
+
+@contextmanager
+def timed_cycle(task: str, interval: float):
+    """ Time the block and record it with record_cycle() """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_cycle(task, time.perf_counter() - start, interval)
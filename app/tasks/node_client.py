@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+HTTP client for the node agent API
+
+Every node gets one NodeClient with a small pool of keep-alive connections, so the
+requests done by the scheduled tasks within (and between) cycles reuse the same
+TCP (and TLS) connection instead of opening a new one per request.
+"""
+
+import json
+import random
+import socket
+import time
+import http.client
+from urllib.parse import quote
+from http.cookies import SimpleCookie
+from queue import LifoQueue, Empty, Full
+from threading import Lock
+
+from app.config import NODE_CONNECT_TIMEOUT, NODE_READ_TIMEOUT, NODE_CUBICLE_TIMEOUT
+from app.config import NODE_RETRIES, NODE_RETRY_BACKOFF, NODE_POOL_SIZE
+from app.extensions import logger
+
+# Status codes worth another try
+RETRY_STATUS = (502, 503, 504)
+
+class NodeClientError(Exception):
+    """ Request to a node failed. 'status' is None when no response was received """
+    def __init__(self, message: str, status: int|None = None, body: str = ""):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+def construct_node_url(node) -> str:
+    """ Construct the URL for a Node """
+    if node.domain_name:
+        url = f"http://{node.domain_name}:{node.port}"
+    else:
+        url = f"http://{node.ip_address}:{node.port}"
+    return url
+
+# pylint: disable-next=R0902:too-many-instance-attributes
+class NodeClient():
+    """ Client for one node agent, with a pool of persistent connections """
+
+    # pylint: disable-next=R0913:too-many-arguments
+    def __init__(self, host: str, port: int, scheme: str = "http",
+                 connect_timeout: float = NODE_CONNECT_TIMEOUT,
+                 read_timeout: float = NODE_READ_TIMEOUT,
+                 retries: int = NODE_RETRIES,
+                 pool_size: int = NODE_POOL_SIZE):
+        self.host = host
+        self.port = int(port)
+        self.scheme = scheme
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self._pool = LifoQueue(maxsize=pool_size)
+        # Requests done with this client. Shared by the threads using it
+        self.requests = 0
+        self._requests_lock = Lock()
+
+    @property
+    def url(self) -> str:
+        """ Base URL of the node """
+        return f"{self.scheme}://{self.host}:{self.port}"
+
+    # Typed API
+    def is_alive(self, timeout: float|None = None) -> bool:
+        """ True if the node answers 200 on '/'. Raises NodeClientError if unreachable """
+        status, _, _ = self.request("GET", "/", read_timeout=timeout, connect_timeout=timeout, retries=0)
+        return status == 200
+
+    def list_cubicles(self) -> list[dict]:
+        """ Cubicles running on the node """
+        return self._results(self._request_ok("GET", "/api/v1/cubicle"))
+
+    def list_networks(self) -> list[dict]:
+        """ Networks present on the node """
+        return self._results(self._request_ok("GET", "/api/v1/network"))
+
+    def put_network(self, network: dict) -> dict:
+        """ Create a network on the node """
+        return self._request_ok("PUT", "/api/v1/network", network)
+
+    def put_cubicle(self, cubicle: dict) -> dict:
+        """ Start a cubicle on the node. Allowed to take longer than other requests """
+        return self._request_ok("PUT", "/api/v1/cubicle", cubicle, read_timeout=NODE_CUBICLE_TIMEOUT)
+
+    def delete_cubicle(self, name: str) -> dict:
+        """ Stop and remove a cubicle from the node """
+        return self._request_ok("DELETE", f"/api/v1/cubicle/{quote(name, safe='')}", read_timeout=NODE_CUBICLE_TIMEOUT)
+
+    def login(self) -> str|None:
+        """ Login and return session cookie """
+        status, headers, _ = self.request("GET", "/api/v1/login")
+        if status != 200:
+            return None
+        cookies = SimpleCookie()
+        for header in headers.get_all("Set-Cookie") or []:
+            cookies.load(header)
+        if "session" not in cookies:
+            return None
+        return cookies["session"].value
+
+    # Transport
+    # pylint: disable-next=R0913:too-many-arguments
+    def request(self, method: str, path: str, data: dict|None = None,
+                connect_timeout: float|None = None,
+                read_timeout: float|None = None,
+                retries: int|None = None) -> tuple[int, http.client.HTTPMessage, bytes]:
+        """
+        Send a request and return (status, headers, body). Connection errors and
+        RETRY_STATUS are retried with exponential backoff and jitter.
+        """
+        retries = self.retries if retries is None else retries
+        body = json.dumps(data).encode("utf-8") if data is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+
+        attempt = 0
+        while True:
+            try:
+                status, response_headers, response_body = self._send(method, path, body, headers,
+                                                                      connect_timeout, read_timeout)
+            except (OSError, http.client.HTTPException) as _err:
+                if attempt >= retries:
+                    raise NodeClientError(f"{method} {self.url}{path} failed: {_err}") from _err
+            else:
+                if status not in RETRY_STATUS or attempt >= retries:
+                    return status, response_headers, response_body
+
+            attempt += 1
+            delay = NODE_RETRY_BACKOFF * (2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+    # pylint: disable-next=R0913:too-many-arguments
+    def _send(self, method, path, body, headers, connect_timeout, read_timeout):
+        connection, reused = self._acquire(connect_timeout)
+        try:
+            return self._exchange(connection, method, path, body, headers, read_timeout)
+        except socket.timeout:
+            connection.close()
+            raise
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+
+        # The idle connection was closed by the node. Try once more with a new one
+        connection, _ = self._acquire(connect_timeout, reuse=False)
+        try:
+            return self._exchange(connection, method, path, body, headers, read_timeout)
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+
+    # pylint: disable-next=R0913:too-many-arguments
+    def _exchange(self, connection, method, path, body, headers, read_timeout):
+        connection.sock.settimeout(read_timeout or self.read_timeout)
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        response_body = response.read()
+        with self._requests_lock:
+            self.requests += 1
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return response.status, response.headers, response_body
+
+    def _acquire(self, connect_timeout: float|None, reuse: bool = True):
+        """ Get an idle connection from the pool or open a new one. Returns (connection, reused) """
+        while reuse:
+            try:
+                connection = self._pool.get_nowait()
+            except Empty:
+                break
+            if connection.sock is not None:
+                return connection, True
+
+        timeout = connect_timeout or self.connect_timeout
+        if self.scheme == "https":
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        connection.connect()
+        return connection, False
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def close(self):
+        """ Close all pooled connections """
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                return
+
+    def _request_ok(self, method: str, path: str, data: dict|None = None, **kwargs) -> dict:
+        status, _, body = self.request(method, path, data, **kwargs)
+        text = body.decode("utf-8", errors="replace")
+        if status < 200 or status >= 300:
+            raise NodeClientError(f"{method} {self.url}{path} returned {status}", status, text)
+        if not text:
+            return {}
+        try:
+            return json.loads(text)
+        except ValueError as _err:
+            raise NodeClientError(f"{method} {self.url}{path} returned invalid JSON", status, text) from _err
+
+    @staticmethod
+    def _results(json_data: dict) -> list[dict]:
+        return json_data["results"] if "results" in json_data else []
+
+    def __repr__(self):
+        return f'<NodeClient "{self.url}">'
+
+_clients = {}
+_clients_lock = Lock()
+
+def get_client(node) -> NodeClient:
+    """ Return the shared client for a node (anything with domain_name, ip_address and port) """
+    host = node.domain_name if node.domain_name else str(node.ip_address)
+    key = (host, int(node.port))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = NodeClient(host, node.port)
+            _clients[key] = client
+            logger.debug(f"Created {client}")
+    return client
+
+def close_clients():
+    """ Close all pooled connections to all nodes """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
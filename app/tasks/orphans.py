@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Grace period and capacity accounting for orphaned cubicles
+
+A cubicle running on a node without being wanted there is an orphan. It is only removed
+when it has been an orphan for NODE_ORPHAN_GRACE seconds, so a cubicle that is activated
+(or moved) while a cycle runs is not removed by mistake. The time a cubicle was first
+seen as an orphan is kept in Redis, shared by all workers. If Redis can not be reached
+nothing is removed.
+"""
+
+import re
+import time
+
+import redis
+
+from app.extensions import logger
+from app.tasks.locks import KEY_PREFIX
+
+# Docker style memory limit, e.g. "512m" or "2g"
+_MEM_LIMIT = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*$", re.IGNORECASE)
+_MEM_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+def _key(node_id: int) -> str:
+    return f"{KEY_PREFIX}:nodes:{node_id}:orphans"
+
+def expired_orphans(node_id: int, orphans: set[str], grace: float, client: redis.Redis) -> set[str]:
+    """
+    Remember when each of 'orphans' was first seen on the node and forget cubicles that
+    are no longer orphans. Returns the orphans older than 'grace' seconds.
+    """
+    now = time.time()
+    try:
+        seen = {k.decode("utf-8"): float(v) for k, v in client.hgetall(_key(node_id)).items()}
+        pipe = client.pipeline()
+        gone = [name for name in seen if name not in orphans]
+        if gone:
+            pipe.hdel(_key(node_id), *gone)
+        new = {name: now for name in orphans if name not in seen}
+        if new:
+            pipe.hset(_key(node_id), mapping=new)
+        pipe.execute()
+    except (redis.RedisError, ValueError) as _err:
+        logger.warning(f"Could not track orphans on node {node_id} ({_err}). Nothing is removed")
+        return set()
+
+    return {name for name in orphans if seen.get(name, now) + grace <= now}
+
+def forget_orphans(node_id: int, names: list[str], client: redis.Redis):
+    """ Forget removed orphans """
+    if not names:
+        return
+    try:
+        client.hdel(_key(node_id), *names)
+    except redis.RedisError as _err:
+        logger.warning(f"Could not forget orphans on node {node_id}: {_err}")
+
+def parse_mem_limit(mem_limit: str|None) -> int:
+    """ Bytes of a memory limit like "1g". 0 if not set or not understood """
+    if not mem_limit:
+        return 0
+    match = _MEM_LIMIT.match(mem_limit)
+    if match is None:
+        return 0
+    return int(float(match.group(1)) * _MEM_UNITS[match.group(2).lower()])
+
+def format_bytes(amount: int) -> str:
+    """ Human readable amount of bytes, e.g. "1.5g" """
+    for unit in ("g", "m", "k"):
+        if amount >= _MEM_UNITS[unit]:
+            return f"{amount / _MEM_UNITS[unit]:.1f}{unit}"
+    return f"{amount}b"
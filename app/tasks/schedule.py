@@ -3,52 +3,107 @@
 
 """ Celery scheduled tasks """
 
-import json
-import socket
 import time
-import urllib.request
-from http.cookiejar import CookieJar
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 
+import redis
 from celery import shared_task
 from celery import current_app as current_celery_app
 
-from sqlalchemy.orm import selectinload
-from sqlalchemy import select
+from sqlalchemy import insert, or_, select, update
 
+from app.config import NODE_PROBE_TIMEOUT, NODE_PROBE_WORKERS, NODE_PROBE_DEADLINE
+from app.config import NODE_RECONCILE_WORKERS, NODE_RECONCILE_DEADLINE, NODE_LOCK_TTL
+from app.config import NODE_ORPHAN_GRACE, NODE_DELETE_BATCH, NODE_DELETE_WORKERS
+from app.config import RECONCILE_NOW_RETRIES, NODE_REPORT_MAX_AGE
+from app.config import CHECK_ALL_NODES_INTERVAL, CHECK_NODE_COMPLIANCE_INTERVAL
+from app.config import CUBICLE_IDLE_TIMEOUT, REAP_IDLE_CUBICLES_INTERVAL, DESIRED_STATE_RETENTION
 from app.extensions import db, logger
 
 from app.models.cubicle import Cubicle
-from app.models.network import Network
+from app.models.events import EventLog
+from app.models.revision import CHANGE_REMOVED, record_changes, prune_changes
+from app.models.report import reporting_nodes
+from app.models.user import User
 from app.models.node import Node
 from app.models.node import STATUS_UP, STATUS_ERROR, STATUS_DOWN
 from app.models.measurements import ResponseTimeCubicle, ResponseTimeNode
+from app.tasks.node_client import NodeClientError, construct_node_url, get_client
+from app.tasks.locks import KEY_PREFIX, single_flight, record_skip, timed_cycle, get_redis
+from app.tasks.breaker import HEALTHY, load_health, record_results, forget_nodes
+from app.tasks.desired_state import DesiredCubicle, DesiredNetwork, DesiredNode, build_desired_state
+from app.tasks.orphans import expired_orphans, forget_orphans, parse_mem_limit, format_bytes
+
+def probe_node(node, timeout: float = NODE_PROBE_TIMEOUT) -> int:
+    """ Probe a node and return its status """
+    try:
+        if get_client(node).is_alive(timeout):
+            return STATUS_UP
+        return STATUS_ERROR
+    except NodeClientError:
+        return STATUS_DOWN
+
+def probe_nodes(nodes: list,
+                workers: int = NODE_PROBE_WORKERS,
+                timeout: float = NODE_PROBE_TIMEOUT,
+                deadline: float = NODE_PROBE_DEADLINE) -> dict[int, int]:
+    """
+    Probe nodes concurrently. Returns {node_id: status} for every node that answered
+    (or failed) before the deadline. Nodes still being probed are left out.
+    """
+    statuses = {}
+    if not nodes:
+        return statuses
+
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(nodes)))
+    futures = {}
+    for node in nodes:
+        logger.info(f"Checking if {node.name} ({construct_node_url(node)}) is alive")
+        futures[executor.submit(probe_node, node, timeout)] = node.id
 
-def construct_node_url(node: Node) -> str:
-    """ Construct the URL for a Node """
-    if node.domain_name != "":
-        url = f"http://{node.domain_name}:{node.port}"
-    else:
-        url = f"http://{node.ip_address}:{node.port}"
-    return url
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            statuses[futures[future]] = future.result()
+    except FutureTimeoutError:
+        # pylint: disable-next=C0301:line-too-long
+        logger.warning(f"Node probing hit the deadline ({deadline}s). {len(nodes) - len(statuses)} node(s) not checked")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return statuses
 
 @shared_task(bind=True)
 # pylint: disable-next=W0613:unused-argument
 def check_all_nodes(self):
-    """ Check if all nodes are alive """
-    nodes = db.session.execute(select(Node)).scalars().all()
-    for node in nodes:
-        logger.info(f"Checking if {node.name} ({url}) is alive")
-        url = construct_node_url(node)
-        try:
-            with urllib.request.urlopen(f"{url}", timeout=2) as response:
-                if response.getcode() == 200:
-                    node.status = STATUS_UP
-                else:
-                    node.status = STATUS_ERROR
-        except (urllib.error.HTTPError, urllib.error.URLError, socket.timeout):
-            node.status = STATUS_DOWN
-
+    """ Check if all nodes are alive. Skipped if the previous run is still in progress """
+    ttl = NODE_PROBE_DEADLINE + CHECK_ALL_NODES_INTERVAL
+    with single_flight("check_all_nodes", ttl) as acquired:
+        if not acquired:
+            record_skip("check_all_nodes")
+            return
+        with timed_cycle("check_all_nodes", CHECK_ALL_NODES_INTERVAL):
+            _check_all_nodes()
+
+def _check_all_nodes():
+    nodes = db.session.execute(select(Node.id, Node.name, Node.domain_name, Node.ip_address, Node.port)).all()
+
+    # Nodes pushing status reports are alive and need no probe
+    reporting = reporting_nodes()
+    statuses = {node.id: STATUS_UP for node in nodes if node.id in reporting}
+
+    # Failing nodes are only checked when their backoff / open circuit allows it
+    health = load_health()
+    forget_nodes([node_id for node_id in health if node_id not in {node.id for node in nodes}])
+    now = time.time()
+    due = [node for node in nodes if node.id not in reporting and health.get(node.id, HEALTHY).is_due(now)]
+
+    statuses.update(probe_nodes(due))
+    if not statuses:
+        return
+    record_results({_id: status == STATUS_UP for _id, status in statuses.items()}, health)
+
+    db.session.execute(update(Node), [{"id": _id, "status": status} for _id, status in statuses.items()])
     db.session.commit()
 
 # @current_celery_app.task()
@@ -112,199 +167,423 @@ def check_all_nodes(self):
 #         db.session.commit()
 
 @shared_task(bind=True)
+# pylint: disable-next=W0613:unused-argument
 def check_node_compliance(self):
-    """ Check if node is compliant """
-    db.session.query(Node)
-    for node in Node.query.all():
-        if node.domain_name != "":
-            url = f"http://{node.domain_name}:{node.port}"
-        else:
-            url = f"http://{node.ip_address}:{node.port}"
-
-        logger.info(f"Checking status of {node.name} ({url})")
-        # Compare running / expected cubicles
-        body = None
+    """
+    Check if nodes are compliant. Every node is reconciled in parallel.
+    Skipped if the previous run is still in progress.
+    """
+    ttl = NODE_RECONCILE_DEADLINE + CHECK_NODE_COMPLIANCE_INTERVAL
+    with single_flight("check_node_compliance", ttl) as acquired:
+        if not acquired:
+            record_skip("check_node_compliance")
+            return None
+        with timed_cycle("check_node_compliance", CHECK_NODE_COMPLIANCE_INTERVAL):
+            state = build_desired_state()
+            # Nodes backing off or with an open circuit are left for check_all_nodes
+            health = load_health()
+            now = time.time()
+            nodes, waiting = [], []
+            for node in state.values():
+                (nodes if health.get(node.id, HEALTHY).is_due(now) else waiting).append(node)
+            reports = reconcile_nodes(nodes)
+
+    for node in waiting:
+        report = _new_report(node)
+        report["skipped"] = True
+        report["error"] = f"Not checked, node is in state {health[node.id].state(now)}"
+        reports.append(report)
+
+    for report in reports:
+        # pylint: disable-next=C0301:line-too-long
+        logger.info(f"Reconciled {report['node']} in {report['duration']:.2f}s. Started: {len(report['started'])}, removed: {len(report['removed'])}, failed: {len(report['failed'])}, error: {report['error']}")
+
+    freed_cpu = sum(report["freed_cpu"] for report in reports)
+    freed_mem = sum(report["freed_mem"] for report in reports)
+    if freed_cpu or freed_mem:
+        logger.info(f"Removed orphaned cubicles freed {freed_cpu} CPU and {format_bytes(freed_mem)} memory")
+    return reports
+
+@shared_task(bind=True, ignore_result=True)
+# pylint: disable-next=W0613:unused-argument
+def reconcile_node_now(self, node_id: int, cubicle_names: list[str]|None = None):
+    """
+    Reconcile a single node right away, e.g. when a cubicle is activated.
+    With 'cubicle_names' set, only those cubicles are started/stopped.
+    If the node is already being reconciled, the task is retried a bit later.
+    """
+    with single_flight(f"node:{node_id}", NODE_LOCK_TTL) as acquired:
+        if not acquired:
+            raise self.retry(countdown=1, max_retries=RECONCILE_NOW_RETRIES)
+        state = build_desired_state([node_id])
+        if node_id not in state:
+            return None
+        report = reconcile_node(state[node_id], cubicle_names)
+    # pylint: disable-next=C0301:line-too-long
+    logger.info(f"Reconciled {report['node']} ({cubicle_names}) in {report['duration']:.2f}s. Started: {len(report['started'])}, removed: {len(report['removed'])}, failed: {len(report['failed'])}, error: {report['error']}")
+    return report
+
+def request_reconcile(node_id: int|None, cubicle_names: list[str]|None = None):
+    """ Queue a reconciliation of a node. Errors are logged, never raised """
+    if node_id is None:
+        return
+    try:
+        reconcile_node_now.delay(node_id, cubicle_names)
+    # pylint: disable=W0718:broad-exception-caught
+    except Exception as _err:
+        logger.warning(f"Could not queue reconciliation of node {node_id}: {_err}")
+
+@shared_task(bind=True)
+# pylint: disable-next=W0613:unused-argument
+def reap_idle_cubicles(self):
+    """
+    Deactivate the cubicles of users idle for more than CUBICLE_IDLE_TIMEOUT seconds, and
+    prune desired state changes older than DESIRED_STATE_RETENTION seconds.
+    Skipped if the previous run is still in progress.
+    """
+    ttl = 2 * REAP_IDLE_CUBICLES_INTERVAL
+    with single_flight("reap_idle_cubicles", ttl) as acquired:
+        if not acquired:
+            record_skip("reap_idle_cubicles")
+            return 0
+        with timed_cycle("reap_idle_cubicles", REAP_IDLE_CUBICLES_INTERVAL):
+            deactivated = deactivate_idle_cubicles(datetime.utcnow() - timedelta(seconds=CUBICLE_IDLE_TIMEOUT))
+            prune_changes(datetime.utcnow() - timedelta(seconds=DESIRED_STATE_RETENTION))
+            db.session.commit()
+
+    for node_id, names in deactivated.items():
+        request_reconcile(node_id, names)
+    return sum(len(names) for names in deactivated.values())
+
+def deactivate_idle_cubicles(cutoff: datetime) -> dict[int, list[str]]:
+    """
+    Deactivate all active cubicles whose owner has been idle since 'cutoff', with one
+    UPDATE, and add an EventLog entry for each of them with one INSERT.
+    Returns the deactivated cubicle names per node, {node_id: [name, ...]}.
+    """
+    # last_activity is flushed from the web workers every ACTIVITY_FLUSH_INTERVAL seconds
+    idle_users = select(User.id).where(or_(User.last_activity.is_(None), User.last_activity < cutoff))
+    stmt = (
+        update(Cubicle)
+        # pylint: disable-next=C0121:singleton-comparison
+        .where(Cubicle.active == True, Cubicle.user_id.in_(idle_users))
+        .values(active=False)
+        .returning(Cubicle.name, Cubicle.user_id, Cubicle.node_id)
+        .execution_options(synchronize_session=False)
+    )
+    rows = db.session.execute(stmt).all()
+    if not rows:
+        db.session.commit()
+        return {}
+
+    db.session.execute(insert(EventLog), [
+        {
+            "user_id": user_id,
+            "type": "cubicle",
+            "text": f"Deactivated idle cubicle '{name}'"[:64],
+        } for name, user_id, _ in rows
+    ])
+    # The bulk UPDATE bypasses the ORM events, so record the new revision here
+    record_changes(db.session.connection(), [(node_id, name, CHANGE_REMOVED) for name, _, node_id in rows])
+    db.session.commit()
+
+    deactivated = {}
+    for name, _, node_id in rows:
+        logger.info(f"Removed cubicle '{name}' from active state, owner has been idle since {cutoff}")
+        deactivated.setdefault(node_id, []).append(name)
+    return deactivated
+
+def reconcile_nodes(nodes: list[DesiredNode],
+                    workers: int = NODE_RECONCILE_WORKERS,
+                    deadline: float = NODE_RECONCILE_DEADLINE) -> list[dict]:
+    """
+    Reconcile nodes concurrently. A node is only compared against its desired state,
+    so no database access happens here and a failing or slow node does not affect the others.
+    Returns a report per node. Nodes not done before the deadline are reported as such.
+    """
+    if not nodes:
+        return []
+
+    reports = {}
+    lock_client = get_redis()
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(nodes)))
+    futures = {executor.submit(_reconcile_node_locked, node, lock_client): node.id for node in nodes}
+
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            reports[futures[future]] = future.result()
+    except FutureTimeoutError:
+        logger.warning(f"Reconciliation hit the deadline ({deadline}s)")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for node in nodes:
+        if node.id not in reports:
+            reports[node.id] = _new_report(node)
+            reports[node.id]["duration"] = deadline
+            reports[node.id]["error"] = "Deadline exceeded"
+
+    return [reports[node.id] for node in nodes]
+
+def _new_report(node: DesiredNode) -> dict:
+    return {
+        "node_id": node.id,
+        "node": node.name,
+        "started": [],
+        "removed": [],
+        "failed": [],
+        "freed_cpu": 0,
+        "freed_mem": 0,
+        "error": None,
+        "skipped": False,
+        "duration": 0.0,
+    }
+
+def _reconcile_node_locked(node: DesiredNode, lock_client) -> dict:
+    """ Reconcile a node unless someone else is already doing it """
+    with single_flight(f"node:{node.id}", NODE_LOCK_TTL, lock_client) as acquired:
+        if acquired:
+            return reconcile_node(node, redis_client=lock_client)
+
+    report = _new_report(node)
+    report["skipped"] = True
+    report["error"] = "Already being reconciled"
+    return report
+
+def reconcile_node(node: DesiredNode, only: list[str]|None = None, redis_client=None) -> dict:
+    """
+    Make sure a node runs the cubicles it should, and nothing else. Returns a report for the node.
+    If 'only' is set, cubicles with other names are left as they are and the named ones
+    are removed without grace period. 'redis_client' is needed outside of an app context.
+    """
+    report = _new_report(node)
+    start = time.perf_counter()
+    redis_client = redis_client or get_redis()
+    try:
+        _reconcile_node(node, report, only, redis_client)
+    # pylint: disable=W0718:broad-exception-caught
+    except Exception as _err:
+        logger.info(f"Reconciliation of {node.name} failed: {_err}")
+        report["error"] = f"{_err}"
+    finally:
+        if only is not None:
+            _record_targeted_run(node.id, redis_client)
+        report["duration"] = time.perf_counter() - start
+    return report
+
+def _targeted_run_key(node_id: int) -> str:
+    return f"{KEY_PREFIX}:nodes:{node_id}:targeted"
+
+def _record_targeted_run(node_id: int, redis_client):
+    """ Remember when a targeted run ('only') on the node ended """
+    # Long enough to outlive every report that was fresh when a full cycle loaded its state
+    ttl = int(NODE_REPORT_MAX_AGE + NODE_RECONCILE_DEADLINE) + 1
+    try:
+        redis_client.set(_targeted_run_key(node_id), f"{time.time():.3f}", ex=ttl)
+    except redis.RedisError as _err:
+        logger.warning(f"Could not record reconciliation of node {node_id}: {_err}")
+
+def _report_is_current(node: DesiredNode, redis_client) -> bool:
+    """
+    True if the status report of the node was received after the last targeted run on it.
+    A report from before may miss cubicles that run started or include ones it removed
+    """
+    try:
+        ended = redis_client.get(_targeted_run_key(node.id))
+        ended = float(ended) if ended is not None else None
+    except (redis.RedisError, ValueError) as _err:
+        logger.warning(f"Could not check reconciliation of node {node.id} ({_err}). Asking the node")
+        return False
+    return ended is None or node.reported_at.replace(tzinfo=timezone.utc).timestamp() > ended
+
+def _reconcile_node(node: DesiredNode, report: dict, only: list[str]|None, redis_client):
+    client = get_client(node)
+
+    # Compare running / expected cubicles. Use the last status report if the node pushed
+    # one recently and after the last targeted run, else ask the node. Targeted runs
+    # ('only') always ask, as the report may not include a change made moments ago
+    reported = only is None and node.reported_cubicles is not None and _report_is_current(node, redis_client)
+    if reported:
+        logger.info(f"Checking status of {node.name} (reported)")
+        inventory = node.reported_cubicles
+    else:
+        logger.info(f"Checking status of {node.name} ({client.url})")
         try:
-            # pylint: disable=C0301:line-too-long
-            with urllib.request.urlopen(f"{url}/api/v1/cubicle", timeout=2) as response:
-                body = response.read().decode("utf-8")
-                logger.info(f"{body}")
-        except urllib.error.HTTPError as _err:
-            error_body = _err.read().decode("utf-8")
-            logger.info(f"{_err} - {error_body}")
+            inventory = {c.get("name"): c for c in client.list_cubicles() if c.get("name")}
+        except NodeClientError as _err:
+            logger.info(f"{_err} {_err.body}")
+            report["error"] = f"{_err}"
+            return
+    running_cubicles = set(inventory)
+
+    # Check if all expecting cubicles are running. If not, start it.
+    missing = []
+    for cubicle in node.cubicles.values():
+        if only is not None and cubicle.name not in only:
+            continue
+        if cubicle.name in running_cubicles:
             continue
-        except urllib.error.URLError as _err:
-            logger.info(f"{_err}")
+        logger.info(f"{cubicle.name} is not running. lets start it!")
+        missing.append(cubicle)
+
+    if missing:
+        networks = _ensure_networks(client, [c.network for c in missing if c.network is not None],
+                                    node.reported_networks if reported else None)
+
+    for cubicle in missing:
+        if cubicle.network is None:
+            logger.info(f"{cubicle.name} have no network on {node.name}")
+            report["failed"].append(cubicle.name)
             continue
-        except socket.timeout:
-            logger.info(f"Timed out while checking access to {node.name} ({node.ip_address}:{node.port})")
+        if cubicle.network.name not in networks:
+            report["failed"].append(cubicle.name)
             continue
 
-        json_data = json.loads(body)
-        json_data = json_data["results"] if "results" in json_data else []
-        running_cubicles = [cubicle.get("name") for cubicle in json_data]
-
-        stmt = (
-            select(Cubicle)
-            .options(selectinload(Cubicle.node))
-            .where(Cubicle.active is True, Cubicle.node_id == node.id)
-        )
-        active_cubicles = db.session.execute(stmt).scalars().all()
-
-        # Check if all expecting cubicles are running. If not, start it.
-        for cubicle in active_cubicles:
-            if cubicle.name in running_cubicles:
-                continue
-            logger.info(f"{cubicle.name} is not running. lets start it!")
-
-            # Check if network exist
-            stmt = select(Network).where(
-                Network.node_id == node.id,
-                Network.user_id == cubicle.user_id
-            )
-            network = db.session.execute(stmt).scalars().first()
-            try:
-                network_exist = _check_network_exist(network, node, url)
-            except Exception as _err:
-                logger.info(_err)
-                continue
-            if not network_exist:
-                # {
-                #  "name": "net-1",
-                #  "driver": "bridge",
-                #  "ipam": {
-                #     "driver": "default",
-                #     "pool_configs": [{
-                #         "subnet": "192.168.0.0/24",
-                #         "gateway": "192.168.0.254"
-                #     }],
-                #     "options": {}
-                #  }
-                # }
-                logger.info("Network do not exist. lets start it!")
-                data = {
-                    "name": network.name,
-                    "driver": "bridge",
-                    "ipam": {
-                        "driver": "default",
-                        "pool_configs": [{
-                            "subnet": str(network.ip_range),
-                            "gateway": str(network.ip_range[-2])
-                        }],
-                        "options": {}
-                    }
-                }
-                try:
-                    data = json.dumps(data).encode("utf-8")
-                    req = urllib.request.Request(f"{url}/api/v1/network",
-                                                headers={"Content-Type": "application/json"},
-                                                data=data,
-                                                method='PUT')
-                    with urllib.request.urlopen(req, timeout=2) as response:
-                        body = response.read().decode("utf-8")
-                        logger.info(f"Network {network.name} started! {body}")
-                except urllib.error.HTTPError as _err:
-                    error_body = _err.read().decode("utf-8")
-                    logger.info(f"{_err} - {error_body}")
-                    continue
-                except urllib.error.URLError as _err:
-                    logger.info(f"{_err}")
-                    continue
-                except socket.timeout:
-                    logger.info(f"Timed out while adding network ({network.name}) on {node.name} ({node.ip_address}:{node.port})")
-                    continue
-            # Start cubicle
-            # {
-            #  "hostname": "machine-1.domain.internal",
-            #  "name": "machine-1",
-            #  "owner": "user-1",
-            #  "image": "divisora/cubicle-ubuntu:latest",
-            #  "network": "net-1",
-            #  "caps": [],
-            #  "environments": {},
-            #  "novnc_port": 30000,
-            #  "ports": {},
-            #  "volumes": []
-            # }
-            data = {
-                "name": cubicle.name,
-                "hostname": cubicle.name + ".domain.internal", # Make domain dynamic!
-                "owner": cubicle.user.name,
-                "image": cubicle.image.image,
-                "network": network.name,
-                "caps": [],
-                "environments": {},
-                "novnc_port": cubicle.novnc_port,
-                "ports": {},
-                "volumes": []
-            }
-            try:
-                data = json.dumps(data).encode("utf-8")
-                req = urllib.request.Request(f"{url}/api/v1/cubicle",
-                                             headers={"Content-Type": "application/json"},
-                                             data=data,
-                                             method='PUT')
-                # Are 10 seconds too much?
-                with urllib.request.urlopen(req, timeout=10) as response:
-                    body = response.read().decode("utf-8")
-                    logger.info(f"Cubicle {cubicle.name} started! {body}")
-            except urllib.error.HTTPError as _err:
-                error_body = _err.read().decode("utf-8")
-                logger.info(f"{_err} - {error_body}")
-                continue
-            except urllib.error.URLError as _err:
-                logger.info(f"{_err}")
-                continue
-            except socket.timeout:
-                logger.info(f"Timed out while adding cubicle ({cubicle.name}) on {node.name} ({node.ip_address}:{node.port})")
-                continue
-
-        # Check if any cubicle is still running when it should have been stopped / removed
-        for cubicle in running_cubicles:
-            if cubicle in active_cubicles:
-                continue
-            print(f"{cubicle} is still running. lets remove it!")
-
-# Make node or url the main way of getting the address
-def _check_network_exist(network: Network, node: Node, url: str) -> bool:
-    try:
-        # pylint: disable=C0301:line-too-long
-        with urllib.request.urlopen(f"{url}/api/v1/network", timeout=2) as response:
-            if response.getcode() != 200:
-                raise Exception("Did not get a 200 return code")
-            body = response.read()
-    except (urllib.error.HTTPError, urllib.error.URLError) as _err:
-        raise _err
-    except socket.timeout as _err:
-        raise Exception(f"Timed out while check networks for {node.name} ({node.ip_address}:{node.port})") from _err
-
-    json_data = json.loads(body)
-    networks = json_data["results"] if "results" in json_data else []
-    for name in [network.get("name") for network in networks]:
-        if name == network.name:
-            return True
-    return False
-
-def login(url: str) -> str|None:
-    """ Login and return session cookie """
+        try:
+            body = client.put_cubicle(cubicle_spec(cubicle))
+            logger.info(f"Cubicle {cubicle.name} started! {body}")
+        except NodeClientError as _err:
+            logger.info(f"{_err} {_err.body}")
+            report["failed"].append(cubicle.name)
+            continue
+        report["started"].append(cubicle.name)
 
-    cookie_jar = CookieJar()
-    try:
-        with urllib.request.urlopen(f"{url}/api/v1/login", timeout=2) as response:
-            if response.getcode() != 200:
-                return None
-            cookies = cookie_jar.make_cookies(response, None)
-    except (urllib.error.HTTPError, urllib.error.URLError):
-        print("Got http error")
-        return None
-    except socket.timeout:
-        print("Timed out")
-        return None
+    # Check if any cubicle is still running when it should have been stopped / removed
+    orphans = running_cubicles - node.cubicles.keys()
+    if only is not None:
+        orphans &= set(only)
+    else:
+        orphans = expired_orphans(node.id, orphans, NODE_ORPHAN_GRACE, redis_client)
+    if orphans:
+        _remove_orphans(client, node, orphans, inventory, report)
+        forget_orphans(node.id, report["removed"], redis_client)
+
+def _remove_orphans(client, node: DesiredNode, orphans: set[str], inventory: dict, report: dict):
+    """
+    Remove orphaned cubicles, NODE_DELETE_WORKERS at a time and at most NODE_DELETE_BATCH
+    per call. The CPU and memory limits of their images are added to the report as freed.
+    """
+    names = sorted(orphans)[:NODE_DELETE_BATCH]
+    if len(orphans) > len(names):
+        logger.info(f"{len(orphans) - len(names)} orphaned cubicle(s) on {node.name} left for the next run")
+
+    def remove(name: str) -> bool:
+        logger.info(f"{name} is still running. lets remove it!")
+        try:
+            client.delete_cubicle(name)
+        except NodeClientError as _err:
+            logger.info(f"{_err} {_err.body}")
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=min(NODE_DELETE_WORKERS, len(names))) as executor:
+        results = list(executor.map(remove, names))
+
+    for name, removed in zip(names, results):
+        if not removed:
+            report["failed"].append(name)
+            continue
+        report["removed"].append(name)
+        image = node.images.get(inventory[name].get("image") or node.inactive.get(name))
+        if image is not None:
+            report["freed_cpu"] += image.cpu_limit or 0
+            report["freed_mem"] += parse_mem_limit(image.mem_limit)
+
+def network_spec(network: DesiredNetwork) -> dict:
+    """
+    Network as expected by the node agent, e.g.
+    {
+     "name": "net-1",
+     "driver": "bridge",
+     "ipam": {
+        "driver": "default",
+        "pool_configs": [{
+            "subnet": "192.168.0.0/24",
+            "gateway": "192.168.0.254"
+        }],
+        "options": {}
+     }
+    }
+    """
+    return {
+        "name": network.name,
+        "driver": "bridge",
+        "ipam": {
+            "driver": "default",
+            "pool_configs": [{
+                "subnet": str(network.ip_range),
+                "gateway": str(network.ip_range[-2])
+            }],
+            "options": {}
+        }
+    }
+
+def cubicle_spec(cubicle: DesiredCubicle) -> dict:
+    """
+    Cubicle as expected by the node agent, e.g.
+    {
+     "hostname": "machine-1.domain.internal",
+     "name": "machine-1",
+     "owner": "user-1",
+     "image": "divisora/cubicle-ubuntu:latest",
+     "network": "net-1",
+     "caps": [],
+     "environments": {},
+     "novnc_port": 30000,
+     "ports": {},
+     "volumes": []
+    }
+    """
+    return {
+        "name": cubicle.name,
+        "hostname": cubicle.name + ".domain.internal", # Make domain dynamic!
+        "owner": cubicle.owner,
+        "image": cubicle.image,
+        "network": cubicle.network.name,
+        "caps": [],
+        "environments": {},
+        "novnc_port": cubicle.novnc_port,
+        "ports": {},
+        "volumes": []
+    }
+
+def _ensure_networks(client, networks: list[DesiredNetwork], reported: set[str]|None = None) -> set[str]:
+    """
+    Create the networks missing on the node. The inventory of the node is only fetched
+    once, and not at all if 'reported' (from a status report) is given.
+    Returns the names of the networks present on the node afterwards.
+    """
+    if reported is not None:
+        inventory = set(reported)
+    else:
+        try:
+            inventory = {n.get("name") for n in client.list_networks()}
+        except NodeClientError as _err:
+            logger.info(f"{_err} {_err.body}")
+            return set()
 
-    for cookie in cookies:
-        if cookie.name != "session":
+    for network in {n.name: n for n in networks}.values():
+        if network.name in inventory:
+            continue
+        logger.info(f"Network {network.name} do not exist. lets start it!")
+        try:
+            body = client.put_network(network_spec(network))
+        except NodeClientError as _err:
+            logger.info(f"{_err} {_err.body}")
             continue
-        print(f"Session key is: {cookie.value}")
-        return cookie.value
+        logger.info(f"Network {network.name} started! {body}")
+        inventory.add(network.name)
+
+    return inventory
+
+def login(node) -> str|None:
+    """ Login and return session cookie """
+    try:
+        session_key = get_client(node).login()
+    except NodeClientError as _err:
+        print(f"Got http error: {_err}")
+        return None
 
-    return None
+    if session_key is not None:
+        print(f"Session key is: {session_key}")
+    return session_key
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Command line for response time samples
+
+- flask measurements migrate [--batch-size 5000] [--remove]
+"""
+
+import click
+from flask.cli import AppGroup
+
+from app.config import RTT_INGEST_BATCH
+
+from app.models.timeseries import migrate_legacy_samples
+
+measurements_cli = AppGroup("measurements", help="Response time samples")
+
+@measurements_cli.command("migrate")
+@click.option("--batch-size", default=RTT_INGEST_BATCH, show_default=True, help="Measurements copied per statement")
+@click.option("--remove", is_flag=True, help="Delete the old rows once copied. Rows that can not be copied are kept")
+def migrate(batch_size: int, remove: bool):
+    """ Copy samples from response_time_cubicle / response_time_node to rtt_sample """
+    copied = migrate_legacy_samples(batch_size, remove)
+    click.echo(f"Copied {copied['cubicle']} cubicle and {copied['node']} node samples")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Downsampling of time series for charts
+
+Both methods keep the shape of a series when it is drawn 'threshold' points wide:
+- lttb: Largest-Triangle-Three-Buckets (Steinarsson, 2013). Picks the point of every
+  bucket that forms the largest triangle with its neighbours
+- minmax: the lowest and highest point of every bucket, so no spike is lost
+
+The first and the last point are always kept. 'x' must be sorted.
+"""
+
+LTTB = "lttb"
+MINMAX = "minmax"
+METHODS = (LTTB, MINMAX)
+
+def lttb(x: list, y: list, threshold: int) -> tuple[list, list]:
+    """ Downsample to at most 'threshold' points with Largest-Triangle-Three-Buckets """
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return list(x), list(y)
+
+    out_x = [x[0]]
+    out_y = [y[0]]
+    # Buckets between the first and the last point
+    every = (length - 2) / (threshold - 2)
+    selected = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+
+        # Average of the next bucket, or the last point
+        next_start = end
+        next_end = min(int((i + 2) * every) + 1, length)
+        if next_start >= next_end:
+            next_start, next_end = length - 1, length
+        count = next_end - next_start
+        avg_x = sum(x[next_start:next_end]) / count
+        avg_y = sum(y[next_start:next_end]) / count
+
+        point_x = x[selected]
+        point_y = y[selected]
+        largest = -1.0
+        for j in range(start, end):
+            area = abs((point_x - avg_x) * (y[j] - point_y) - (point_x - x[j]) * (avg_y - point_y))
+            if area > largest:
+                largest = area
+                selected = j
+        out_x.append(x[selected])
+        out_y.append(y[selected])
+
+    out_x.append(x[-1])
+    out_y.append(y[-1])
+    return out_x, out_y
+
+def minmax(x: list, y: list, threshold: int) -> tuple[list, list]:
+    """ Downsample to at most 'threshold' points, keeping the min and max of every bucket """
+    length = len(x)
+    if threshold >= length or threshold < 4:
+        return list(x), list(y)
+
+    out_x = [x[0]]
+    out_y = [y[0]]
+    buckets = (threshold - 2) // 2
+    every = (length - 2) / buckets
+    for i in range(buckets):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        if start >= end:
+            continue
+        low = min(range(start, end), key=y.__getitem__)
+        high = max(range(start, end), key=y.__getitem__)
+        # In time order, once if min and max are the same point
+        for j in sorted({low, high}):
+            out_x.append(x[j])
+            out_y.append(y[j])
+
+    out_x.append(x[-1])
+    out_y.append(y[-1])
+    return out_x, out_y
+
+def downsample(x: list, y: list, threshold: int, method: str = LTTB) -> tuple[list, list]:
+    """ Downsample with 'method' (LTTB or MINMAX) """
+    if method == MINMAX:
+        return minmax(x, y, threshold)
+    return lttb(x, y, threshold)
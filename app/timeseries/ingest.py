@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Batched ingestion of response time samples
+
+Producers (e.g. the status reports of the nodes) only append samples to an in-memory
+buffer. The buffer is written to RttSample in bulk every flush interval, or as soon as
+it holds RTT_INGEST_BATCH samples, so many small reports become a few large inserts.
+"""
+
+import atexit
+import math
+import time
+from datetime import datetime
+from threading import Lock, Thread
+
+from flask import Flask
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app.config import RTT_BUFFER_BATCHES, RTT_FLUSH_INTERVAL, RTT_INGEST_BATCH
+from app.extensions import db, logger
+
+from app.models.timeseries import KINDS, insert_samples
+
+class SampleBuffer():
+    """ Collect samples and flush them in bulk """
+
+    def __init__(self, flush_interval: float = RTT_FLUSH_INTERVAL, batch_size: int = RTT_INGEST_BATCH):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._app = None
+        self._flusher = None
+
+    def init_app(self, app: Flask):
+        """ Bind buffer to the Flask app. Pending samples are flushed on exit """
+        self._app = app
+        app.extensions["sample_buffer"] = self
+        atexit.register(self._flush_with_context)
+
+    def add(self, kind: str, entity_id: int, rtt: float, timestamp: datetime|None = None):
+        """ Add one sample of a cubicle or node """
+        self.add_many([(kind, entity_id, rtt, timestamp)])
+
+    def add_many(self, samples: list[tuple[str, int, float, datetime|None]]):
+        """
+        Add (kind, entity_id, rtt, timestamp) samples. 'kind' is "cubicle" or "node". Samples
+        without entity or with an RTT that is not a finite number are dropped
+        """
+        rows = []
+        for kind, entity_id, rtt, timestamp in samples:
+            if entity_id is None:
+                continue
+            if isinstance(rtt, bool) or not isinstance(rtt, (int, float)) or not math.isfinite(rtt):
+                logger.warning(f"Dropped response time sample of {kind} {entity_id}, bad RTT {rtt!r}")
+                continue
+            rows.append({"kind": KINDS[kind], "entity_id": entity_id,
+                         "timestamp": timestamp or datetime.utcnow(), "rtt": float(rtt)})
+        with self._lock:
+            self._pending += rows
+            full = len(self._pending) >= self.batch_size
+        if full and not self._flush_lock.locked():
+            Thread(target=self._flush_with_context, name="sample-flush", daemon=True).start()
+        self._ensure_flusher()
+
+    def pending(self) -> int:
+        """ Number of samples not written yet """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """
+        Write all pending samples, committing every batch. Returns the number of samples
+        written. Must be called within an app context
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+
+            written = 0
+            for first in range(0, len(pending), self.batch_size):
+                try:
+                    written += self._write(pending[first:first + self.batch_size])
+                # pylint: disable=W0718:broad-exception-caught
+                except Exception as _error:
+                    db.session.rollback()
+                    logger.warning(f"Could not write {len(pending) - first} response time samples: {_error}")
+                    # Put the samples back so they are retried on the next flush. Keep the
+                    # newest if the database stays away
+                    keep = self.batch_size * RTT_BUFFER_BATCHES
+                    with self._lock:
+                        self._pending = (pending[first:] + self._pending)[-keep:]
+                    break
+            return written
+
+    def _write(self, samples: list[dict]) -> int:
+        """
+        Insert and commit samples. If the database rejects the batch, it is split in halves
+        until the samples at fault are found. Those are dropped, so they do not block the
+        samples queued after them
+        """
+        try:
+            insert_samples(samples, self.batch_size)
+            db.session.commit()
+            return len(samples)
+        except (IntegrityError, DataError) as _error:
+            db.session.rollback()
+            if len(samples) == 1:
+                logger.warning(f"Dropped response time sample {samples[0]}: {_error.orig}")
+                return 0
+            half = len(samples) // 2
+            return self._write(samples[:half]) + self._write(samples[half:])
+
+    def _ensure_flusher(self):
+        """ Start the background flusher the first time something is added """
+        if self._flusher is not None or self._app is None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = Thread(target=self._run, name="sample-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_with_context()
+
+    def _flush_with_context(self):
+        if self._app is None:
+            return
+        with self._app.app_context():
+            self.flush()
+
+sample_buffer = SampleBuffer()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Resampling of time series to a fixed step with NumPy
+
+Samples are put in buckets of 'step' seconds ending at 'end', averaged per bucket, and
+buckets without a sample are filled with zero, NaN or the previous value. Everything is
+done with array operations, so the cost does not depend on how long a gap is.
+"""
+
+import numpy as np
+
+FILL_ZERO = "zero"
+FILL_NAN = "nan"
+FILL_FORWARD = "ffill"
+FILLS = (FILL_ZERO, FILL_NAN, FILL_FORWARD)
+
+def resample(epochs, values, end: float, step: float = 60.0, start: float|None = None,
+             fill: str = FILL_ZERO) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Resample to one value per 'step' seconds. Returns (epoch seconds, values) of the
+    buckets, oldest first. Bucket k covers (end - (k + 1) * step, end - k * step] and is
+    stamped with its end. The first bucket is the one of the oldest sample, or the one
+    of 'start' if given. Samples after 'end' are ignored. Without samples (and 'start')
+    the series is empty.
+    """
+    if fill not in FILLS:
+        raise ValueError(f"Unknown fill '{fill}', use one of {', '.join(FILLS)}")
+
+    epochs = np.asarray(epochs, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    keep = epochs <= end
+    epochs = epochs[keep]
+    values = values[keep]
+    if start is None:
+        if len(epochs) == 0:
+            return np.empty(0), np.empty(0)
+        count = int((end - epochs.min()) // step) + 1
+    else:
+        keep = epochs > start
+        epochs = epochs[keep]
+        values = values[keep]
+        count = max(1, int(np.ceil((end - start) / step)))
+
+    # Buckets counted backwards from 'end'
+    index = count - 1 - ((end - epochs) // step).astype(np.int64)
+
+    sums = np.bincount(index, weights=values, minlength=count)
+    samples = np.bincount(index, minlength=count)
+    present = samples > 0
+    result = np.full(count, np.nan)
+    result[present] = sums[present] / samples[present]
+
+    if fill == FILL_ZERO:
+        result[~present] = 0.0
+    elif fill == FILL_FORWARD:
+        # Index of the latest bucket with a sample, up to every bucket
+        latest = np.maximum.accumulate(np.where(present, np.arange(count), -1))
+        result = np.where(latest >= 0, result[np.maximum(latest, 0)], np.nan)
+
+    times = end - step * np.arange(count - 1, -1, -1, dtype=np.float64)
+    return times, result
+
+def to_datetime64(epochs) -> np.ndarray:
+    """ Epoch seconds as datetime64 (UTC), e.g. for the x-axis of a graph """
+    return np.asarray(np.round(np.asarray(epochs, dtype=np.float64)), dtype=np.int64).astype("datetime64[s]")
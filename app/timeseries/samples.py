@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Response time samples of cubicles and nodes
+
+Samples are read from RttSample by range scans of its primary key (kind, entity_id,
+timestamp), i.e. always with the kind, the entity and a lower bound on the timestamp.
+"""
+
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.extensions import db
+
+from app.models.cubicle import Cubicle
+from app.models.node import Node
+from app.models.timeseries import KIND_CUBICLE, KIND_NODE, RttSample
+
+class SampleSource(NamedTuple):
+    """ Entities of a kind of samples """
+    model: type
+    name: object
+    kind: int
+
+SOURCES = {
+    "cubicle": SampleSource(Cubicle, Cubicle.name, KIND_CUBICLE),
+    "node": SampleSource(Node, Node.name, KIND_NODE),
+}
+
+def entity_name(kind: str, entity_id: int) -> str|None:
+    """ Name of a cubicle or node, None if it does not exist """
+    source = SOURCES[kind]
+    name = db.session.execute(select(source.model.id, source.name).where(source.model.id == entity_id)).first()
+    return None if name is None else name[1] or ""
+
+def load_series(kind: str, since: datetime,
+                entity_ids: list[int]|None = None) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """
+    Samples after 'since' (UTC) of every cubicle/node, or of 'entity_ids', with one column
+    query. Returns {entity_id: (epoch seconds, RTTs)}, oldest first. Entities without
+    samples are left out
+    """
+    stmt = (
+        select(RttSample.entity_id, RttSample.timestamp, RttSample.rtt)
+        .where(RttSample.kind == SOURCES[kind].kind, RttSample.timestamp > since)
+        .order_by(RttSample.entity_id, RttSample.timestamp)
+    )
+    if entity_ids is not None:
+        stmt = stmt.where(RttSample.entity_id.in_(entity_ids))
+
+    rows = db.session.execute(stmt).all()
+    if not rows:
+        return {}
+    ids, timestamps, rtts = zip(*rows)
+    ids = np.array(ids, dtype=np.int64)
+    # Timestamps are stored as naive UTC
+    epochs = np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+    # NaN is a valid float in some databases, count it (and NULL) as 0 like older versions
+    rtts = np.nan_to_num(np.array(rtts, dtype=np.float64), nan=0.0)
+
+    # Rows are ordered by entity, so every entity is one slice
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1))
+    ends = np.append(starts[1:], len(ids))
+    return {int(ids[first]): (epochs[first:end], rtts[first:end]) for first, end in zip(starts, ends)}
+
+def load_samples(kind: str, entity_id: int, since: datetime) -> tuple[list[int], list[float]]:
+    """ Epoch seconds and RTTs of the samples of one cubicle/node after 'since' (UTC), oldest first """
+    epochs, rtts = load_series(kind, since, [entity_id]).get(entity_id, (np.empty(0), np.empty(0)))
+    return epochs.tolist(), rtts.tolist()
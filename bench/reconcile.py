@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fleet-scale benchmark of the scheduled node tasks
+
+Starts N simulated node agents on localhost, seeds a scratch database with N nodes and
+M active cubicles spread over them, and runs check_all_nodes / check_node_compliance
+back to back until every agent runs exactly its cubicles. For each cycle the duration,
+the requests done to the agents and the database queries are reported, followed by the
+time it took to converge.
+
+- python bench/reconcile.py --nodes 200 --cubicles 2000 --latency 0.005
+- python bench/reconcile.py --nodes 50 --cubicles 500 --error-rate 0.05 --json
+
+Redis (locks, backoff, orphans) is taken from --redis. If it can not be reached the
+tasks run without it, as they do in production.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from ipaddress import ip_network
+from itertools import islice
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def parse_args():
+    """ Command line arguments """
+    parser = argparse.ArgumentParser(description="Benchmark reconciliation against simulated nodes")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--cubicles", type=int, default=1000, help="Active cubicles, spread over the nodes")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every agent request")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of agent requests answered with 503")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Share of agent requests that hang")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Seconds a hanging request hangs")
+    parser.add_argument("--max-cycles", type=int, default=20, help="Give up converging after this many cycles")
+    parser.add_argument("--steady", type=int, default=2, help="Cycles to run after convergence")
+    parser.add_argument("--database", help="SQLAlchemy URI. Default is a temporary SQLite file")
+    parser.add_argument("--redis", default="redis://127.0.0.1:6379/15")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    return parser.parse_args()
+
+ARGS = parse_args()
+_tmp = None
+if ARGS.database is None:
+    # pylint: disable-next=R1732:consider-using-with
+    _tmp = tempfile.NamedTemporaryFile(prefix="divisora-bench-", suffix=".db", delete=False)
+    ARGS.database = f"sqlite:///{_tmp.name}"
+os.environ["SQLALCHEMY_DATABASE_URI"] = ARGS.database
+
+# pylint: disable=C0413:wrong-import-position
+from sqlalchemy import event, insert
+
+from app import create_app
+from app.extensions import db, logger
+from app.models.cubicle import Cubicle
+from app.models.image import Image
+from app.models.network import Network
+from app.models.node import Node
+from app.models.user import User
+from app.simulator.node_agent import start_fleet, stop_fleet
+from app.tasks import schedule
+from app.tasks.desired_state import build_desired_state
+from app.tasks.node_client import close_clients
+
+def seed(agents: list, cubicles: int):
+    """ Insert one node per agent and 'cubicles' active cubicles, each with its own owner """
+    db.session.execute(insert(Image), [{"name": "bench", "image": "divisora/cubicle-bench:latest",
+                                        "cpu_limit": 1, "mem_limit": "1g"}])
+    image_id = db.session.execute(db.select(Image.id)).scalar()
+
+    db.session.execute(insert(Node), [
+        {"name": f"bench-node-{i}", "domain_name": agent.host, "port": agent.port, "status": 0}
+        for i, agent in enumerate(agents)
+    ])
+    node_ids = db.session.execute(db.select(Node.id).order_by(Node.id)).scalars().all()
+
+    db.session.execute(insert(User), [
+        {"name": f"Bench User {i}", "username": f"bench-user-{i}", "admin": False}
+        for i in range(cubicles)
+    ])
+    user_ids = db.session.execute(db.select(User.id).where(User.username.like("bench-user-%"))
+                                  .order_by(User.id)).scalars().all()
+
+    subnets = islice(ip_network("10.0.0.0/8").subnets(new_prefix=26), cubicles)
+    networks, rows = [], []
+    for i, (user_id, subnet) in enumerate(zip(user_ids, subnets)):
+        node_id = node_ids[i % len(node_ids)]
+        networks.append({"name": f"bench-net-{i}", "ip_range": subnet, "node_id": node_id, "user_id": user_id})
+        rows.append({"name": f"bench-cubicle-{i}", "active": True, "novnc_port": 30000 + i // len(node_ids),
+                     "image_id": image_id, "user_id": user_id, "node_id": node_id})
+    db.session.execute(insert(Network), networks)
+    db.session.execute(insert(Cubicle), rows)
+    db.session.commit()
+
+@contextmanager
+def measure(agents: list, result: dict):
+    """ Record duration, agent requests and database queries of the block in 'result' """
+    queries = [0]
+    def count(*_):
+        queries[0] += 1
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    requests = sum(agent.request_count() for agent in agents)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        result["duration"] = time.perf_counter() - start
+        result["requests"] = sum(agent.request_count() for agent in agents) - requests
+        result["queries"] = queries[0]
+        event.remove(engine, "before_cursor_execute", count)
+
+def converged(agents: list, desired: dict) -> bool:
+    """ True if every agent runs exactly its desired cubicles """
+    return all(set(agent.cubicles) == desired[i] for i, agent in enumerate(agents))
+
+def run(agents: list) -> dict:
+    """ Run cycles until converged plus the steady cycles. Returns the results """
+    state = build_desired_state()
+    by_port = {node.port: set(node.cubicles) for node in state.values()}
+    desired = [by_port.get(agent.port, set()) for agent in agents]
+
+    cycles = []
+    converged_after = None
+    elapsed = 0.0
+    steady = 0
+    while len(cycles) < ARGS.max_cycles + ARGS.steady:
+        cycle = {"cycle": len(cycles) + 1, "check_all_nodes": {}, "check_node_compliance": {}}
+        with measure(agents, cycle["check_all_nodes"]):
+            schedule.check_all_nodes()
+        with measure(agents, cycle["check_node_compliance"]):
+            schedule.check_node_compliance()
+        cycles.append(cycle)
+        elapsed += cycle["check_all_nodes"]["duration"] + cycle["check_node_compliance"]["duration"]
+
+        if converged_after is None:
+            if converged(agents, desired):
+                converged_after = {"cycles": len(cycles), "seconds": elapsed}
+            elif len(cycles) >= ARGS.max_cycles:
+                break
+        else:
+            steady += 1
+            if steady >= ARGS.steady:
+                break
+
+    return {
+        "nodes": len(agents),
+        "cubicles": sum(len(names) for names in desired),
+        "cycles": cycles,
+        "converged": converged_after,
+    }
+
+def print_result(result: dict):
+    """ Print the result as a table """
+    print(f"{result['nodes']} nodes, {result['cubicles']} cubicles")
+    print(f"{'cycle':>5} {'task':<22} {'seconds':>9} {'requests':>9} {'queries':>8}")
+    for cycle in result["cycles"]:
+        for task in ("check_all_nodes", "check_node_compliance"):
+            numbers = cycle[task]
+            # pylint: disable-next=C0301:line-too-long
+            print(f"{cycle['cycle']:>5} {task:<22} {numbers['duration']:>9.3f} {numbers['requests']:>9} {numbers['queries']:>8}")
+    if result["converged"] is None:
+        print(f"Did not converge within {ARGS.max_cycles} cycles")
+    else:
+        print(f"Converged after {result['converged']['cycles']} cycle(s), {result['converged']['seconds']:.3f}s")
+
+def main():
+    """ Run the benchmark """
+    app = create_app()
+    app.config["CELERY"]["broker_url"] = ARGS.redis
+    logger.setLevel("ERROR")
+
+    agents = start_fleet(ARGS.nodes, latency=ARGS.latency, jitter=ARGS.jitter,
+                         error_rate=ARGS.error_rate, timeout_rate=ARGS.timeout_rate, timeout=ARGS.timeout)
+    try:
+        with app.app_context():
+            db.create_all()
+            seed(agents, ARGS.cubicles)
+            result = run(agents)
+    finally:
+        close_clients()
+        stop_fleet(agents)
+        if _tmp is not None:
+            os.unlink(_tmp.name)
+
+    if ARGS.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
+
+if __name__ == "__main__":
+    main()
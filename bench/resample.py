@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of gap filling: the per-minute padding loop the graphs used before against
+the vectorized resampling in app/timeseries/resample.py
+
+Each scenario is a series of one sample per minute over the time range, with outages
+where no samples were taken. Both are timed on the same samples.
+
+- python bench/resample.py
+- python bench/resample.py --hours 168 --outage 0.5 --repeat 20 --json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=C0413:wrong-import-position
+from app.timeseries.resample import FILL_ZERO, resample
+
+def parse_args():
+    """ Command line arguments """
+    parser = argparse.ArgumentParser(description="Benchmark gap filling of RTT series")
+    parser.add_argument("--hours", type=int, nargs="+", default=[8, 48, 168], help="Time ranges to run")
+    parser.add_argument("--outage", type=float, nargs="+", default=[0.0, 0.1, 0.9],
+                        help="Share of the time range without samples, as one outage before the latest hour")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per scenario, the best is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    return parser.parse_args()
+
+def make_samples(now: datetime, hours: int, outage: float) -> list[tuple[datetime, float]]:
+    """ One sample per minute, newest first, except during the outage """
+    minutes = hours * 60
+    outage_end = 60
+    outage_start = outage_end + int(minutes * outage)
+    return [
+        (now - timedelta(minutes=i, seconds=random.random()), float(random.randint(1, 50)))
+        for i in range(minutes) if not outage_end <= i < outage_start
+    ]
+
+def pad_loop(now: datetime, samples: list[tuple[datetime, float]]) -> tuple[list, list]:
+    """ The padding loop of the graphs before the vectorized resampling """
+    x_axis = []
+    y_axis = []
+    for timestamp, rtt in samples:
+        compare_time = x_axis[-1] - timedelta(minutes=1) if x_axis else now
+        while timestamp < compare_time:
+            x_axis.append(compare_time)
+            y_axis.append(0.0)
+            compare_time -= timedelta(minutes=1)
+        x_axis.append(timestamp)
+        y_axis.append(rtt)
+    return x_axis, y_axis
+
+def vectorized(now: datetime, samples: list[tuple[datetime, float]]) -> tuple:
+    """ Resample to one value per minute """
+    epochs = [timestamp.timestamp() for timestamp, _ in samples]
+    rtts = [rtt for _, rtt in samples]
+    return resample(epochs, rtts, end=now.timestamp(), step=60, fill=FILL_ZERO)
+
+def best_of(repeat: int, func, *args) -> tuple[float, int]:
+    """ Best duration of 'repeat' runs and the number of points returned """
+    best = None
+    points = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        x_axis, _ = func(*args)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+        points = len(x_axis)
+    return best, points
+
+def main():
+    """ Run the benchmark """
+    args = parse_args()
+    random.seed(args.seed)
+    now = datetime.now()
+
+    results = []
+    for hours in args.hours:
+        for outage in args.outage:
+            samples = make_samples(now, hours, outage)
+            loop, loop_points = best_of(args.repeat, pad_loop, now, samples)
+            numpy, numpy_points = best_of(args.repeat, vectorized, now, samples)
+            results.append({
+                "hours": hours,
+                "outage": outage,
+                "samples": len(samples),
+                "loop": {"seconds": loop, "points": loop_points},
+                "vectorized": {"seconds": numpy, "points": numpy_points},
+                "speedup": loop / numpy if numpy else None,
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'hours':>5} {'outage':>6} {'samples':>8} {'loop ms':>9} {'numpy ms':>9} {'speedup':>8} {'points':>13}")
+    for result in results:
+        # pylint: disable-next=C0301:line-too-long
+        print(f"{result['hours']:>5} {result['outage']:>6.0%} {result['samples']:>8} {result['loop']['seconds'] * 1000:>9.2f} {result['vectorized']['seconds'] * 1000:>9.2f} {result['speedup']:>7.1f}x {result['loop']['points']:>6}/{result['vectorized']['points']:<6}")
+
+if __name__ == "__main__":
+    main()